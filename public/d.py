@@ -12,6 +12,7 @@ import requests
 from bs4 import BeautifulSoup
 import re
 import time
+import hashlib
 
 class CompleteFixProxyHandler(http.server.BaseHTTPRequestHandler):
     """完整修复的代理处理器 - 同时修复新闻跳转和搜索问题"""
@@ -28,6 +29,8 @@ class CompleteFixProxyHandler(http.server.BaseHTTPRequestHandler):
             
             if self.path == '/':
                 self._serve_homepage()
+            elif self.path.startswith('/__proxy/intercept.'):
+                self._serve_interception_script()
             elif self.path.startswith('/proxy?url='):
                 self._proxy_webpage()
             elif self.path.startswith('/proxy?') and 'url=' not in self.path:
@@ -423,9 +426,7 @@ class CompleteFixProxyHandler(http.server.BaseHTTPRequestHandler):
             soup.append(body_tag)
 
         # 注入增强的JavaScript拦截代码 - 关键修复新闻跳转
-        interception_script = self._get_enhanced_interception_script(base_url)
-        script_tag = soup.new_tag('script')
-        script_tag.string = interception_script
+        script_tag = soup.new_tag('script', attrs={'src': self.interception_script_path, 'data-base-url': base_url})
         if body_tag:
             body_tag.append(script_tag)
         else:
@@ -505,14 +506,15 @@ class CompleteFixProxyHandler(http.server.BaseHTTPRequestHandler):
         pattern = r'url\(["\']?([^"\'()]*)["\']?\)'
         return re.sub(pattern, replace_url, css_content)
 
-    def _get_enhanced_interception_script(self, base_url):
-        """获取增强的JavaScript拦截代码 - 彻底修复新闻跳转"""
-        return '''
+    # 增强的JavaScript拦截代码，作为独立脚本输出，浏览器可长期缓存
+    interception_script = '''
         // 增强的JavaScript拦截代码 - 专门修复新闻跳转
         (function() {
             'use strict';
             
-            var baseUrl = "''' + base_url + '''";
+            // 原页面地址由script标签的data-base-url属性传入
+            var currentScript = document.currentScript;
+            var baseUrl = (currentScript && currentScript.getAttribute('data-base-url')) || document.baseURI;
             
             // 1. 增强的点击事件拦截 - 处理所有可能的新闻链接
             function interceptClickEvent(e) {
@@ -603,6 +605,28 @@ class CompleteFixProxyHandler(http.server.BaseHTTPRequestHandler):
         })();
         '''
 
+    interception_script_path = '/__proxy/intercept.' + hashlib.sha256(interception_script.encode('utf-8')).hexdigest()[:16] + '.js'
+
+    def _serve_interception_script(self):
+        """输出拦截脚本，路径带内容哈希，允许浏览器永久缓存"""
+        if urllib.parse.urlparse(self.path).path != self.interception_script_path:
+            self.send_error(404, "Not Found")
+            return
+        etag = '"' + self.interception_script_path.split('.')[1] + '"'
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = self.interception_script.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/javascript; charset=utf-8')
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def log_message(self, format, *args):
         """自定义日志格式"""
         print("[" + self.log_date_time_string() + "] " + format % args)
@@ -9,19 +9,36 @@ import http.server
 import socketserver
 import urllib.parse
 import requests
-from bsup4 import BeautifulSoup
+from bs4 import BeautifulSoup
 import re
 import time
+import hashlib
 import chardet
+import codecs
+import threading
+import importlib.util
+
+# 已安装lxml时优先使用，解析大页面明显快于html.parser
+DEFAULT_HTML_PARSER = 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
 
 class SoComFixProxyHandler(http.server.BaseHTTPRequestHandler):
     """专门修复360搜索乱码的代理处理器"""
 
     config = {
         'port': 60000,
-        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'html_parser': DEFAULT_HTML_PARSER,
+        'charset_prescan_bytes': 4096,   # 在页面开头查找meta字符集声明的字节数
+        'charset_sample_bytes': 64 * 1024,  # chardet最多检测的字节数
+        'charset_cache_ttl': 600,        # 按主机缓存检测结果的秒数
     }
 
+    # 编码检测: 主机 -> (编码, 过期时间)，以及各级检测的命中次数
+    charset_cache = {}
+    charset_tier_counts = {'bom': 0, 'header': 0, 'meta': 0, 'host_cache': 0, 'chardet': 0, 'default': 0}
+    charset_lock = threading.Lock()
+    meta_charset_pattern = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)
+
     def do_GET(self):
         """处理GET请求"""
         try:
@@ -29,6 +46,8 @@ class SoComFixProxyHandler(http.server.BaseHTTPRequestHandler):
             
             if self.path == '/':
                 self._serve_homepage()
+            elif self.path.startswith('/__proxy/intercept.'):
+                self._serve_interception_script()
             elif self.path.startswith('/proxy?url='):
                 self._proxy_webpage_enhanced()
             elif self.path.startswith('/proxy?') and 'url=' not in self.path:
@@ -152,33 +171,19 @@ class SoComFixProxyHandler(http.server.BaseHTTPRequestHandler):
         """专门重写360搜索内容 - 修复乱码问题"""
         print("检测到360搜索页面，使用专门处理")
         
-        # 360搜索通常使用GBK编码
+        # 360搜索的编码以响应头和meta声明为准，都没有时才按内容检测
+        encoding = self._detect_encoding(response)
         try:
-            # 先尝试GBK编码
+            html_content = response.content.decode(encoding, errors='replace')
+        except LookupError:
             html_content = response.content.decode('gbk', errors='replace')
-            print("使用GBK编码解码成功")
-        except UnicodeDecodeError:
-            try:
-                # 如果GBK失败，尝试GB2312
-                html_content = response.content.decode('gb2312', errors='replace')
-                print("使用GB2312编码解码成功")
-            except UnicodeDecodeError:
-                try:
-                    # 如果GB2312失败，尝试UTF-8
-                    html_content = response.content.decode('utf-8', errors='replace')
-                    print("使用UTF-8编码解码成功")
-                except UnicodeDecodeError:
-                    # 最后使用chardet检测
-                    detected = chardet.detect(response.content)
-                    encoding = detected.get('encoding', 'utf-8')
-                    print(f"使用chardet检测编码: {encoding}")
-                    html_content = response.content.decode(encoding, errors='replace')
+        print(f"使用{encoding}编码解码")
         
         # 使用BeautifulSoup解析并重写
         try:
-            soup = BeautifulSoup(html_content, 'html.parser')
+            soup = BeautifulSoup(html_content, self.config['html_parser'])
         except Exception as e:
-            print(f"BeautifulSoup解析错误: {e}, 使用宽松解析")
+            print(f"BeautifulSoup解析错误: {e}, 改用html.parser解析")
             soup = BeautifulSoup(html_content, 'html.parser')
         
         # 导航栏HTML
@@ -241,9 +246,7 @@ class SoComFixProxyHandler(http.server.BaseHTTPRequestHandler):
             soup.append(body_tag)
 
         # 注入增强的JavaScript拦截代码
-        interception_script = self._get_enhanced_interception_script(base_url)
-        script_tag = soup.new_tag('script')
-        script_tag.string = interception_script
+        script_tag = soup.new_tag('script', attrs={'src': self.interception_script_path, 'data-base-url': base_url})
         if body_tag:
             body_tag.append(script_tag)
         else:
@@ -405,7 +408,6 @@ class SoComFixProxyHandler(http.server.BaseHTTPRequestHandler):
         """带编码处理的HTML内容重写 - 修复乱码问题"""
         # 检测原始编码
         original_encoding = self._detect_encoding(response)
-        print(f"检测到编码: {original_encoding}")
         
         try:
             # 使用正确编码解码内容
@@ -429,51 +431,63 @@ class SoComFixProxyHandler(http.server.BaseHTTPRequestHandler):
         return self._rewrite_html_content_complete(html_content, base_url)
 
     def _detect_encoding(self, response):
-        """检测响应内容的编码"""
-        # 首先检查Content-Type头中的编码
-        content_type = response.headers.get('Content-Type', '').lower()
-        if 'charset=' in content_type:
-            charset_match = re.search(r'charset=([^\s;]+)', content_type)
-            if charset_match:
-                encoding = charset_match.group(1)
-                print(f"从Content-Type检测到编码: {encoding}")
-                return encoding
-        
-        # 检查HTML meta标签中的编码
-        try:
-            # 只检查前2000字节来检测meta标签
-            content_preview = response.content[:2000]
-            soup = BeautifulSoup(content_preview, 'html.parser')
-            meta_charset = soup.find('meta', attrs={'charset': True})
-            if meta_charset:
-                encoding = meta_charset.get('charset')
-                print(f"从meta charset检测到编码: {encoding}")
-                return encoding
-            
-            meta_content_type = soup.find('meta', attrs={'http-equiv': re.compile('content-type', re.I)})
-            if meta_content_type and meta_content_type.get('content'):
-                content_value = meta_content_type.get('content')
-                if 'charset=' in content_value.lower():
-                    charset_match = re.search(r'charset=([^\s;]+)', content_value, re.I)
-                    if charset_match:
-                        encoding = charset_match.group(1)
-                        print(f"从meta http-equiv检测到编码: {encoding}")
-                        return encoding
-        except Exception as e:
-            print(f"解析meta标签错误: {e}")
-        
-        # 使用chardet检测编码
+        """检测响应内容的编码
+
+        依次检查BOM、Content-Type头、页面开头的meta声明、同一主机最近的检测结果，
+        最后才对有限长度的样本运行chardet。
+        """
+        encoding, tier = self._detect_encoding_tiered(response)
+        host = urllib.parse.urlparse(response.url).hostname or ''
+        with self.charset_lock:
+            self.charset_tier_counts[tier] += 1
+            if host and tier in ('header', 'meta', 'chardet'):
+                self.charset_cache[host] = (encoding, time.time() + self.config['charset_cache_ttl'])
+        print(f"检测到编码: {encoding} (来源: {tier}, 累计: {self.charset_tier_counts})")
+        return encoding
+
+    def _detect_encoding_tiered(self, response):
+        """返回(编码, 检测级别)"""
+        content = response.content
+        for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+                              (codecs.BOM_UTF16_BE, 'utf-16')):
+            if content.startswith(bom):
+                return encoding, 'bom'
+
+        # Content-Type头中的编码
+        content_type = response.headers.get('Content-Type', '')
+        charset_match = re.search(r'charset=([^\s;]+)', content_type, re.I)
+        if charset_match and self._valid_encoding(charset_match.group(1)):
+            return charset_match.group(1).strip('"\'').lower(), 'header'
+
+        # 页面开头的meta charset或http-equiv声明
+        meta_match = self.meta_charset_pattern.search(content, 0, self.config['charset_prescan_bytes'])
+        if meta_match:
+            encoding = meta_match.group(1).decode('ascii', errors='ignore').lower()
+            if self._valid_encoding(encoding):
+                return encoding, 'meta'
+
+        host = urllib.parse.urlparse(response.url).hostname or ''
+        with self.charset_lock:
+            cached = self.charset_cache.get(host)
+        if cached and cached[1] > time.time():
+            return cached[0], 'host_cache'
+
+        # 只检测开头的样本，避免对整个页面运行chardet
         try:
-            detected = chardet.detect(response.content)
-            if detected['confidence'] > 0.7:
-                encoding = detected['encoding']
-                print(f"chardet检测到编码: {encoding} (置信度: {detected['confidence']})")
-                return encoding
+            detected = chardet.detect(content[:self.config['charset_sample_bytes']])
+            if detected['encoding'] and detected['confidence'] > 0.7:
+                return detected['encoding'].lower(), 'chardet'
         except Exception as e:
             print(f"chardet检测错误: {e}")
-        
-        print("无法检测编码，使用utf-8")
-        return 'utf-8'
+
+        return 'utf-8', 'default'
+
+    def _valid_encoding(self, encoding):
+        try:
+            codecs.lookup(encoding.strip('"\''))
+            return True
+        except LookupError:
+            return False
 
     def _handle_non_200_response(self, response, target_url):
         """处理非200状态码的响应 - 修复下载文件问题"""
@@ -728,9 +742,9 @@ class SoComFixProxyHandler(http.server.BaseHTTPRequestHandler):
     def _rewrite_html_content_complete(self, html_content, base_url):
         """完整的HTML内容重写 - 同时修复新闻跳转和搜索"""
         try:
-            soup = BeautifulSoup(html_content, 'html.parser')
+            soup = BeautifulSoup(html_content, self.config['html_parser'])
         except Exception as e:
-            print(f"BeautifulSoup解析错误: {e}, 使用宽松解析")
+            print(f"BeautifulSoup解析错误: {e}, 改用html.parser解析")
             soup = BeautifulSoup(html_content, 'html.parser')
 
         nav_html = '''
@@ -792,9 +806,7 @@ class SoComFixProxyHandler(http.server.BaseHTTPRequestHandler):
             soup.append(body_tag)
 
         # 注入增强的JavaScript拦截代码 - 关键修复新闻跳转
-        interception_script = self._get_enhanced_interception_script(base_url)
-        script_tag = soup.new_tag('script')
-        script_tag.string = interception_script
+        script_tag = soup.new_tag('script', attrs={'src': self.interception_script_path, 'data-base-url': base_url})
         if body_tag:
             body_tag.append(script_tag)
         else:
@@ -875,14 +887,15 @@ class SoComFixProxyHandler(http.server.BaseHTTPRequestHandler):
         pattern = r'url\(["\']?([^"\'()]*)["\']?\)'
         return re.sub(pattern, replace_url, css_content)
 
-    def _get_enhanced_interception_script(self, base_url):
-        """获取增强的JavaScript拦截代码 - 彻底修复新闻跳转"""
-        return '''
+    # 增强的JavaScript拦截代码，作为独立脚本输出，浏览器可长期缓存
+    interception_script = '''
         // 增强的JavaScript拦截代码 - 专门修复新闻跳转
         (function() {
             'use strict';
             
-            var baseUrl = "''' + base_url + '''";
+            // 原页面地址由script标签的data-base-url属性传入
+            var currentScript = document.currentScript;
+            var baseUrl = (currentScript && currentScript.getAttribute('data-base-url')) || document.baseURI;
             
             // 1. 增强的点击事件拦截 - 处理所有可能的新闻链接
             function interceptClickEvent(e) {
@@ -973,6 +986,28 @@ class SoComFixProxyHandler(http.server.BaseHTTPRequestHandler):
         })();
         '''
 
+    interception_script_path = '/__proxy/intercept.' + hashlib.sha256(interception_script.encode('utf-8')).hexdigest()[:16] + '.js'
+
+    def _serve_interception_script(self):
+        """输出拦截脚本，路径带内容哈希，允许浏览器永久缓存"""
+        if urllib.parse.urlparse(self.path).path != self.interception_script_path:
+            self.send_error(404, "Not Found")
+            return
+        etag = '"' + self.interception_script_path.split('.')[1] + '"'
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = self.interception_script.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/javascript; charset=utf-8')
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def log_message(self, format, *args):
         """自定义日志格式"""
         print("[" + self.log_date_time_string() + "] " + format % args)
@@ -12,27 +12,175 @@ import http.server
 import socketserver
 import urllib.parse
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 import re
 import time
 import json
+import queue
+import threading
+import asyncio
+import io
+import itertools
+import socket
+import os
+import signal
+import argparse
+import multiprocessing
+import http.cookiejar
+import zlib
+import gzip
+import email.utils
+import codecs
+import html
+import html.parser
+import tracemalloc
+import hashlib
+import heapq
+import functools
+import importlib.util
+import tempfile
+import mmap
+from collections import OrderedDict, deque
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+import urllib3
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
     """修复的代理处理器"""
 
+    # 使用HTTP/1.1才能以分块传输流式转发未知长度的内容
+    protocol_version = 'HTTP/1.1'
+
     config = {
         'port': 60000,
         'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'timeout': 30
+        'connect_timeout': 5,       # 建立上游连接的超时(秒)
+        'read_timeout': 30,         # 访问页面时等待上游单次读取的超时(秒)
+        'resource_read_timeout': 15,  # 访问页面中的资源时等待上游单次读取的超时(秒)
+        'request_deadline': 60,     # 每个客户端请求的总时间预算(秒)，0表示不限制
+        'resource_deadline': 30,    # 资源请求的总时间预算，不超过所在请求的剩余预算
+        'max_workers': 32,          # 工作线程池大小
+        'accept_queue_size': 64,    # 等待处理的连接队列上限，满时直接返回503
+        'engine': 'thread',         # 服务引擎: thread(线程池) 或 async(客户端连接I/O在asyncio中，处理请求仍用线程池)
+        'async_max_connections': 10000,  # async引擎同时保持的最大连接数
+        'keepalive_timeout': 15,    # 空闲连接等待下一个请求的秒数
+        'worker_processes': 1,      # 预派生工作进程数，大于1时启用多进程模式
+        'stats_interval': 60,       # 多进程模式下主进程输出统计的间隔(秒)
+        'pool_connections': 64,     # 保留连接池的上游主机数
+        'pool_maxsize': 16,         # 每个上游主机保留的空闲连接数
+        'pool_idle_timeout': 30,    # 空闲超过该秒数的上游连接不再复用
+        'stream_chunk_size': 64 * 1024,  # 流式转发非HTML内容时每次读取的字节数
+        'html_compression': True,   # 按客户端Accept-Encoding压缩HTML响应
+        'compression_level': 6,     # gzip压缩级别(1-9)
+        'brotli_quality': 5,        # brotli压缩质量(0-11)，需要安装brotli
+        'compression_min_size': 1024,  # 小于该字节数的HTML不压缩
+        'memory_cache_bytes': 64 * 1024 * 1024,  # 静态资源内存缓存的总大小上限
+        'memory_cache_max_entry': 2 * 1024 * 1024,  # 单个缓存条目的大小上限
+        'disk_cache_dir': os.path.join(tempfile.gettempdir(), 'minelibs_proxy_cache'),  # 不能放在public/下，否则会随站点发布
+        'disk_cache_bytes': 4 * 1024 * 1024 * 1024,  # 磁盘缓存总大小上限，0表示禁用
+        'disk_cache_min_size': 2 * 1024 * 1024,  # 达到该大小的下载才写入磁盘缓存
+        'html_rewriter': 'soup',    # HTML重写方式: soup(整页解析) 或 stream(流式逐标签重写)
+        'html_parser': 'auto',      # BeautifulSoup解析器: auto、lxml、html.parser 或 html5lib
+        'url_cache_entries': 16384,  # 页面URL解析结果的缓存条目数
+        'rewrite_processes': 2,     # 重写大页面的进程池大小，0表示全部在当前线程重写
+        'rewrite_process_min_size': 256 * 1024,  # 达到该字节数的页面交给进程池重写
+        'html_rewrite_max_size': 4 * 1024 * 1024,  # 超过该字节数的页面不再整页解析，0表示不限制
+        'oversized_html_mode': 'stream',  # 超大页面的处理方式: stream(流式重写) 或 passthrough(原样转发并注入拦截脚本)
+        'html_early_flush': False,  # 收到上游响应头后立即发出页面开头(字符集、预加载提示和导航栏)
+        'preload_history_pages': 1024,  # 记录预加载资源的页面数
+        'preload_hints_per_page': 8,  # 每个页面最多预加载的样式表和脚本数
+        'charset_prescan_bytes': 4096,  # 在页面开头查找meta字符集声明的字节数
+        'charset_sample_bytes': 64 * 1024,  # 统计检测编码时最多使用的字节数
+        'charset_cache_ttl': 600,   # 按主机缓存检测结果的秒数
+        'request_coalescing': True,  # 同时到达的相同请求共用一次上游访问和重写结果
+        'coalesce_max_bytes': 1024 * 1024,  # 不超过该长度的非HTML响应整体读入内存供合并的请求共享
+        'coalesce_wait_timeout': 60,  # 跟随的请求等待领头请求的秒数，超时后自行访问上游
+        'negative_cache_entries': 4096,  # 记录访问失败的资源URL数上限
+        'negative_cache_hosts': 1024,  # 按主机统计失败次数的主机数上限
+        'negative_cache_ttl': {     # 各类失败在该秒数内直接返回失败，0表示不记录
+            'timeout': 60,          # 连接或读取超时
+            'dns': 300,             # 域名解析失败
+            'connect': 30,          # 连接被拒绝或中断
+            'error': 60,            # 其他网络错误(SSL、重定向过多等)
+            'not_found': 600,       # 404/410
+            'client_error': 120,    # 其他4xx
+            'server_error': 30,     # 5xx
+        },
+        'circuit_breaker': True,    # 按上游主机熔断，持续失败或过慢的主机在一段时间内直接返回失败
+        'breaker_window': 20,       # 统计每个主机最近多少次请求的结果
+        'breaker_min_requests': 10,  # 窗口内至少有这么多次请求才判断是否熔断
+        'breaker_error_rate': 0.5,  # 失败比例达到该值时熔断
+        'breaker_slow_seconds': 10,  # 等待响应头超过该秒数的请求算作过慢
+        'breaker_slow_rate': 0.8,   # 过慢比例达到该值时熔断
+        'breaker_open_seconds': 30,  # 熔断后多少秒放行探测请求
+        'breaker_probes': 1,        # 半开状态下同时放行的探测请求数
+        'breaker_error_statuses': (412, 429),  # 除5xx外算作主机故障的状态码(反爬拦截、限流)
+        'breaker_max_hosts': 1024,  # 跟踪熔断状态的主机数上限
+    }
+
+    # 当前请求是否已经提前发出页面开头，以及需要记录的预加载资源
+    _prelude_sent = False
+    _preload_hints = None
+    # 当前页面是否超过整页重写上限而改为流式输出
+    _page_oversized = False
+
+    # 当前客户端请求的总时间预算，在do_GET/do_POST开始时创建
+    _deadline = None
+
+    # 304响应中保留的响应头
+    not_modified_headers = {'etag', 'last-modified', 'cache-control', 'expires', 'vary', 'content-location'}
+
+    # 单次遍历文档树时按标签名分派的重写规则，'*'中的规则对所有标签生效
+    rewrite_rules = {
+        'a': ('_rule_link',),
+        'form': ('_rule_form',),
+        'img': ('_rule_resource',),
+        'script': ('_rule_resource',),
+        'link': ('_rule_resource',),
+        'iframe': ('_rule_resource',),
+        'source': ('_rule_resource',),
+        'embed': ('_rule_resource',),
+        'object': ('_rule_resource',),
+        'style': ('_rule_style_sheet',),
+        'meta': ('_rule_meta',),
+        '*': ('_rule_inline_style',),
+    }
+
+    # 按目标站点追加的重写规则
+    site_rewrite_rules = {
+        'bilibili.com': {
+            'script': ('_rule_bilibili_script',),
+            'link': ('_rule_bilibili_stylesheet',),
+        },
     }
 
+    meta_refresh_pattern = re.compile(r'^(\s*\d*\s*[;,]?\s*url\s*=\s*)([\'"]?)(.*?)\2\s*$',
+                                      re.IGNORECASE | re.DOTALL)
+    # 原样转发的页面在head开始标签或文档类型声明之后插入base标签
+    head_open_pattern = re.compile(r'<head(?:\s[^>]*)?>', re.IGNORECASE)
+    doctype_pattern = re.compile(r'<!doctype[^>]*>', re.IGNORECASE)
+
     def do_GET(self):
         """处理GET请求"""
         try:
             print(f"请求: {self.path}")
+            self.server.count_request()
+            self._deadline = Deadline(self.config['request_deadline'])
             
             if self.path == '/':
                 self._serve_homepage()
+            elif self.path == '/__proxy/stats':
+                self._serve_stats()
+            elif self.path.startswith('/__proxy/intercept.'):
+                self._serve_interception_script()
             elif self.path.startswith('/proxy?url='):
                 self._proxy_webpage()
             elif self.path.startswith('/proxy?') and 'url=' not in self.path:
@@ -45,6 +193,8 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
     def do_POST(self):
         """处理POST请求"""
         try:
+            self.server.count_request()
+            self._deadline = Deadline(self.config['request_deadline'])
             if self.path.startswith('/proxy?url='):
                 self._proxy_post_request()
             else:
@@ -67,27 +217,129 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
         print(f"目标URL: {target_url}")
 
         headers = self._get_headers(target_url)
+        self._forward_validators(headers)
+
+        # 缓存中只有非HTML资源，命中时无需访问上游
+        handled, stale_entry = self._try_caches(target_url, headers)
+        if handled:
+            return
 
+        # 用户直接打开的页面总是重新访问上游，页面中的资源近期失败过则直接返回失败
+        failure = None if self._is_navigation() else self._negative_cache().lookup(target_url)
+        if failure:
+            if failure.status_code:
+                self._handle_response_error(_SharedResponse(failure.status_code, {}), target_url)
+            else:
+                self.send_error(502, f"Failed to fetch (cached): {failure.message}")
+            return
+
+        key = self._coalesce_key('page', target_url, headers) if stale_entry is None else None
         try:
-            response = requests.get(target_url, headers=headers, timeout=self.config['timeout'], verify=False)
-        except requests.exceptions.RequestException as e:
+            shared, send = self._fetch_coalesced(
+                key, lambda shareable: self._fetch_page(target_url, headers, stale_entry, shareable))
+        except CircuitOpenError as e:
+            self._send_circuit_open(e, target_url)
+            return
+        except DeadlineExceeded as e:
+            self.send_error(504, str(e))
+            return
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
             self.send_error(502, f"Failed to fetch: {str(e)}")
             return
 
-        if response.status_code != 200:
-            self._handle_response_error(response, target_url)
-            return
+        if shared is not None:
+            self._send_shared_response(shared, lambda result: self._handle_response_error(result, target_url))
+        else:
+            send()
+
+    def _fetch_page(self, target_url, headers, stale_entry=None, shareable=False):
+        """访问上游页面，返回(可共享的结果, 发送函数)，两者只有一个不为None
+
+        整页重写的页面总是完整生成，以便共享和计算ETag；shareable为True时小资源也整体读入内存，
+        供合并的请求共享。流式输出的页面和大文件只返回发送函数。
+        """
+        try:
+            response = self._upstream_request('get', target_url, self.config['read_timeout'], headers=headers,
+                                              verify=False, stream=True)
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
+        except requests.exceptions.RequestException as e:
+            self._negative_cache().record_error(target_url, e)
+            raise
+
+        if response.status_code == 304 and stale_entry:
+            return None, lambda: self._serve_revalidated_entry(stale_entry, response)
+
+        # 206/416是对Range请求的响应，直接转发
+        if response.status_code not in (200, 206, 416):
+            response.close()
+            self._negative_cache().record_status(target_url, response.status_code)
+            return _SharedResponse(response.status_code, response.headers), None
 
         content_type = response.headers.get('Content-Type', '').lower()
-        if 'text/html' in content_type:
-            rewritten_content = self._rewrite_html(response.text, target_url)
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html; charset=utf-8')
-            self.send_header('Content-Length', str(len(rewritten_content.encode('utf-8'))))
-            self.end_headers()
-            self.wfile.write(rewritten_content.encode('utf-8'))
-        else:
-            self._proxy_raw_content(response)
+        if 'text/html' in content_type and response.status_code == 200:
+            chunks = self._rewrite_response(response, target_url)
+            # 整页重写的结果已经完整生成，提前发送和流式重写的页面边读边发
+            if self.config['html_rewriter'] == 'soup' and not self._prelude_sent and not self._page_oversized:
+                return _SharedResponse(200, response.headers, html=b''.join(chunks)), None
+            return None, lambda: self._send_html_response(chunks, flush_first=self.config['html_early_flush'])
+        return self._share_raw_content(response, target_url, shareable)
+
+    def _upstream(self):
+        """获取共享的上游HTTP客户端"""
+        return UpstreamClient.shared(self.config)
+
+    def _upstream_request(self, method, url, read_timeout, **kwargs):
+        """经过熔断器访问上游，主机熔断时不发出请求，直接抛出CircuitOpenError
+
+        连接和读取超时按本次请求的剩余预算收紧，跟随重定向前也检查预算；
+        因预算用完而超时时抛出DeadlineExceeded。
+        结果按收到响应头为止的耗时和状态码计入该主机的统计窗口，因预算用完而中止的请求不计入。
+        """
+        deadline = self._deadline or Deadline()
+        kwargs['timeout'] = deadline.timeout(self.config['connect_timeout'], read_timeout)
+        kwargs['hooks'] = {'response': functools.partial(self._check_redirect_deadline, deadline)}
+        send = functools.partial(getattr(self._upstream(), method), url, **kwargs)
+        if not self.config['circuit_breaker']:
+            return self._send_within_deadline(send, deadline)
+        breaker = CircuitBreaker.shared(self.config)
+        host = urllib.parse.urlsplit(url).hostname or ''
+        allowed, probe = breaker.allow(host)
+        if not allowed:
+            raise CircuitOpenError(f"上游主机{host}已熔断。")
+        started = time.monotonic()
+        failed = True
+        try:
+            response = self._send_within_deadline(send, deadline)
+            failed = breaker.is_failure_status(response.status_code)
+            return response
+        except DeadlineExceeded:
+            # 客户端的预算用完不说明上游有问题，不计入统计
+            breaker.release(host, probe)
+            failed = None
+            raise
+        finally:
+            if failed is not None:
+                breaker.record(host, failed, time.monotonic() - started, probe)
+
+    @staticmethod
+    def _send_within_deadline(send, deadline):
+        """发出上游请求，超时发生在预算用完之后时改为DeadlineExceeded"""
+        try:
+            return send()
+        except DeadlineExceeded:
+            raise
+        except requests.exceptions.Timeout as e:
+            if not deadline.expired():
+                raise
+            stage = 'connect' if isinstance(e, requests.exceptions.ConnectTimeout) else 'headers'
+            raise Deadline.exceed(stage) from e
+
+    @staticmethod
+    def _check_redirect_deadline(deadline, response, *args, **kwargs):
+        """requests的响应钩子：预算用完后不再跟随重定向"""
+        if response.is_redirect:
+            deadline.check('redirect')
 
     def _get_headers(self, url):
         """获取请求头"""
@@ -110,34 +362,296 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
             headers['Referer'] = 'https://www.bing.com/'
         else:
             headers['Referer'] = url
-            
+
+        self._forward_range_headers(headers)
         return headers
 
+    def _forward_range_headers(self, headers):
+        """转发客户端的Range/If-Range，支持断点续传和视频拖动"""
+        range_header = self.headers.get('Range')
+        if not range_header:
+            return
+        headers['Range'] = range_header
+        if_range = self.headers.get('If-Range')
+        if if_range:
+            headers['If-Range'] = if_range
+        # 字节范围针对未压缩的内容，避免上游返回无法单独解压的压缩片段
+        headers['Accept-Encoding'] = 'identity'
+
+    def _forward_validators(self, headers):
+        """转发客户端的If-None-Match/If-Modified-Since，让上游可以只回复304
+
+        代理为重写后的HTML生成的ETag对上游没有意义，不转发。
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')
+                    if tag.strip() and not tag.strip().lstrip('W/').startswith('"h-')]
+            if tags:
+                headers['If-None-Match'] = ', '.join(tags)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            headers['If-Modified-Since'] = if_modified_since
+
+    def _rewrite_response(self, response, base_url):
+        """重写上游返回的HTML页面，返回UTF-8字节块
+
+        按配置选择整页解析或流式重写；整页解析时大页面交给进程池，
+        避免长时间占用GIL拖慢其他请求。超过重写上限的页面改为流式处理。
+        启用提前发送时第一块是页面开头，之后才开始读取上游页面。
+        """
+        self._prelude_sent = self.config['html_early_flush']
+        self._preload_hints = [] if self._prelude_sent else None
+        if self._prelude_sent:
+            return self._early_flush_response(response, base_url)
+        return self._rewrite_response_body(response, base_url)
+
+    def _early_flush_response(self, response, base_url):
+        """先输出页面开头，再输出重写后的页面，结束后记录本页的样式表和脚本"""
+        history = PreloadHistory.shared(self.config)
+        yield self._page_prelude(base_url, history.hints(base_url)).encode('utf-8')
+        try:
+            yield from self._rewrite_response_body(response, base_url)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            # 页面开头已经发出，无法再返回错误状态，结束页面并断开连接
+            print(f"页面读取中断: {e}")
+            self.close_connection = True
+            return
+        history.record(base_url, self._preload_hints)
+
+    def _page_prelude(self, base_url, hints):
+        """提前发送的页面开头：字符集声明、预加载提示和导航栏
+
+        页面自身的html/head/body标签随后到达时，浏览器会把属性合并到已有元素上，
+        head中的样式表和脚本仍按原样生效。
+        """
+        preloads = ''.join(f'<link rel="preload" href="{html.escape(url)}" as="{kind}">'
+                           for url, kind in hints)
+        return ('<!DOCTYPE html><html><head><meta charset="utf-8">' + preloads + '</head>'
+                '<body style="margin-top: 50px;">' + self._navigation_html(base_url))
+
+    def _collect_preload_hint(self, tag_name, url):
+        """记录页面引用的样式表和脚本，供下次访问时提前预加载"""
+        hints = self._preload_hints
+        if hints is None or len(hints) >= self.config['preload_hints_per_page']:
+            return
+        if url.startswith('/proxy?url='):
+            hints.append((url, 'style' if tag_name == 'link' else 'script'))
+
+    def _rewrite_response_body(self, response, base_url):
+        """读取并重写上游页面
+
+        整页解析时读取失败直接抛出，不把不完整的页面当作正常结果；
+        边读边发的流式和超限页面读取中断时只结束输出。
+        """
+        body = self._iter_response_bytes(response)
+        if self.config['html_rewriter'] == 'stream':
+            body = self._tolerate_read_errors(body)
+            head, body = self._peek_body(body, self.config['charset_prescan_bytes'])
+            encoding = self._detect_charset(response, b''.join(head))
+            text_chunks = self._iter_decoded(itertools.chain(head, body), encoding)
+            chunks = self._rewrite_html_stream(text_chunks, base_url)
+            return (chunk.encode('utf-8') for chunk in chunks)
+
+        # 有Content-Length时直接判断是否超限，否则边读边计数，超限后已读部分接着流式处理
+        limit = self.config['html_rewrite_max_size']
+        length = response.headers.get('Content-Length', '')
+        head = []
+        if not (limit and length.isdigit() and int(length) > limit):
+            size = 0
+            for chunk in body:
+                head.append(chunk)
+                size += len(chunk)
+                if limit and size > limit:
+                    break
+            else:
+                content = b''.join(head)
+                return self._rewrite_page_content(content, self._detect_charset(response, content), base_url)
+        if not head:
+            head, body = self._peek_body(body, self.config['charset_prescan_bytes'])
+        encoding = self._detect_charset(response, b''.join(head))
+        self._page_oversized = True
+        return self._rewrite_oversized(self._tolerate_read_errors(itertools.chain(head, body)), encoding, base_url)
+
+    def _peek_body(self, body, min_bytes):
+        """先读取页面开头至少min_bytes字节，返回(已读的块, 剩余的块)"""
+        head = []
+        size = 0
+        for chunk in body:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= min_bytes:
+                break
+        return head, body
+
+    def _detect_charset(self, response, sample):
+        """根据响应头和页面开头检测页面编码"""
+        host = urllib.parse.urlsplit(response.url).hostname or ''
+        return CharsetDetector.shared(self.config).detect(
+            sample, response.headers.get('Content-Type', ''), host)
+
+    def _rewrite_page_content(self, content, encoding, base_url):
+        """整页解析重写，达到进程池阈值的页面交给子进程"""
+        pool = RewritePool.shared(self.config)
+        deadline = self._deadline or Deadline()
+        if pool.should_offload(len(content)):
+            result = pool.rewrite(content, encoding, base_url, self.config, self._prelude_sent,
+                                  timeout=deadline.remaining())
+            if result is not None:
+                body, hints = result
+                if self._preload_hints is not None:
+                    self._preload_hints.extend(hints)
+                return [body]
+            # 因预算用完而超时时不再在当前线程重写
+            deadline.check('rewrite')
+        backend = ParserBackend.shared(self.config)
+        markup = backend.prepare_markup(content, encoding, backend.select())
+        chunks = self._rewrite_html_chunks(markup, base_url)
+        return (chunk.encode('utf-8') for chunk in chunks)
+
+    def _rewrite_oversized(self, byte_chunks, encoding, base_url):
+        """处理超过重写上限的页面，不缓冲整个页面"""
+        mode = self.config['oversized_html_mode']
+        print(f"页面超过重写上限，使用{mode}模式: {base_url}")
+        text_chunks = self._iter_decoded(byte_chunks, encoding)
+        if mode == 'passthrough':
+            chunks = self._passthrough_html(text_chunks, base_url)
+        else:
+            chunks = self._rewrite_html_stream(text_chunks, base_url)
+        return (chunk.encode('utf-8') for chunk in chunks)
+
+    def _passthrough_html(self, text_chunks, base_url):
+        """原样转发页面，只补充基准地址让相对链接指向原站，并在末尾注入拦截脚本
+
+        base标签插在head开始标签之后；在页面开头找不到head时插在文档类型声明之后，
+        不能放在声明前面，否则浏览器会按怪异模式渲染。
+        """
+        base_tag = f'<base href="{html.escape(base_url)}">'
+        text_chunks = iter(text_chunks)
+        head = ''
+        for text in text_chunks:
+            head += text
+            match = self.head_open_pattern.search(head)
+            if match:
+                yield head[:match.end()] + base_tag + head[match.end():]
+                break
+            if len(head) >= self.config['charset_prescan_bytes']:
+                yield self._insert_after_doctype(head, base_tag)
+                break
+        else:
+            yield self._insert_after_doctype(head, base_tag)
+        yield from text_chunks
+        yield self._interception_script_tag(base_url, inline=True)
+
+    def _insert_after_doctype(self, text, tag):
+        match = self.doctype_pattern.search(text)
+        position = match.end() if match else 0
+        return text[:position] + tag + text[position:]
+
+    def _iter_response_bytes(self, response):
+        """边下载边读取上游页面，读取失败时抛出异常"""
+        deadline = self._deadline or Deadline()
+        # 单次读取的超时挡不住缓慢滴送数据的上游，预算用完时由看门狗关闭连接打断读取
+        watch = deadline.watch(response)
+        try:
+            for chunk in response.iter_content(self.config['stream_chunk_size']):
+                deadline.check('body')
+                yield chunk
+            # 没有长度的页面被关闭连接时表现为正常结束
+            if watch.fired:
+                raise Deadline.exceed('body')
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            if (watch.fired or deadline.expired()) and not isinstance(e, DeadlineExceeded):
+                raise Deadline.exceed('body') from e
+            raise
+        finally:
+            watch.cancel()
+            response.close()
+
+    def _tolerate_read_errors(self, byte_chunks):
+        """边读边发的页面读取中断时，已输出的部分无法撤回，结束页面并断开连接"""
+        try:
+            yield from byte_chunks
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            print(f"页面读取中断: {e}")
+            self.close_connection = True
+
+    def _iter_decoded(self, byte_chunks, encoding):
+        """增量解码字节块，未声明编码时按UTF-8处理"""
+        try:
+            decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        for chunk in byte_chunks:
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    def _rewrite_html_stream(self, text_chunks, base_url):
+        """流式重写HTML，每读入一块就输出已经改写完成的部分"""
+        rewriter = _StreamingHTMLRewriter(self, base_url)
+        for text in text_chunks:
+            rewriter.feed(text)
+            output = rewriter.take_output()
+            if output:
+                yield output
+        rewriter.close()
+        output = rewriter.take_output()
+        if output:
+            yield output
+
     def _rewrite_html(self, html_content, base_url):
         """重写HTML内容"""
+        return ''.join(self._rewrite_html_chunks(html_content, base_url))
+
+    def _rewrite_html_chunks(self, html_content, base_url, parser=None):
+        """重写HTML内容，返回逐块序列化的结果，parser为空时使用配置选定的解析器"""
         try:
-            soup = BeautifulSoup(html_content, 'html.parser')
+            soup = ParserBackend.shared(self.config).parse(html_content, parser)
         except Exception as e:
             print(f"HTML解析错误: {e}")
-            return self._create_basic_page(html_content, base_url)
+            if isinstance(html_content, bytes):
+                html_content = _decode_html(html_content, 'utf-8')
+            return [self._create_basic_page(html_content, base_url)]
+        return self._rewrite_soup(soup, base_url)
 
-        # 添加导航栏
-        self._add_navigation(soup, base_url)
+    def _rewrite_soup(self, soup, base_url):
+        """重写已解析的文档，返回逐块序列化的结果"""
+        # 一次遍历完成所有链接、资源、样式和站点修复的重写
+        head_tag, body_tag = self._apply_rewrite_rules(soup, base_url)
 
-        # 重写所有链接和资源
-        self._rewrite_all_links(soup, base_url)
+        if self._prelude_sent:
+            # 字符集声明和导航栏已经随页面开头提前发出
+            self._inject_interception_script(soup, body_tag, base_url)
+            return self._iter_html_chunks(soup, soup.contents)
 
-        # 特殊处理哔哩哔哩
-        if 'bilibili.com' in base_url:
-            self._fix_bilibili_issues(soup)
+        # 添加导航栏
+        body_tag = self._add_navigation(soup, base_url, body_tag)
 
         # 注入拦截脚本
-        self._inject_interception_script(soup)
+        self._inject_interception_script(soup, body_tag, base_url)
 
         # 确保字符集
-        self._ensure_charset(soup)
+        self._ensure_charset(soup, head_tag)
 
-        return str(soup)
+        return self._iter_html_chunks(soup, soup.contents)
+
+    def _iter_html_chunks(self, soup, nodes):
+        """逐个节点序列化文档，html和body展开到子节点，结果与str(soup)一致"""
+        for node in nodes:
+            if isinstance(node, Tag) and node.name in ('html', 'body'):
+                closing = '</' + node.name + '>'
+                empty = str(soup.new_tag(node.name, attrs=dict(node.attrs)))
+                yield empty[:-len(closing)]
+                yield from self._iter_html_chunks(soup, node.contents)
+                yield closing
+            elif isinstance(node, Tag):
+                yield node.decode()
+            else:
+                yield node.output_ready()
 
     def _create_basic_page(self, content, base_url):
         """创建基础页面"""
@@ -162,17 +676,20 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
         </html>
         '''
 
-    def _add_navigation(self, soup, base_url):
-        """添加导航栏"""
+    def _navigation_html(self, base_url):
+        """导航栏HTML"""
         # 使用特殊标记的主页链接，避免被重写
-        nav_html = f'''
+        return f'''
         <div style="background: #007cba; color: white; padding: 10px; margin: 0; text-align: center; position: fixed; top: 0; left: 0; right: 0; z-index: 10000;">
             <a href="/" style="color: white; text-decoration: none; font-weight: bold;" data-no-proxy="true">返回主页</a>
             <span style="margin-left: 15px;">代理: {base_url[:60] + '...' if len(base_url) > 60 else base_url}</span>
         </div>
         '''
 
-        body_tag = soup.find('body')
+    def _add_navigation(self, soup, base_url, body_tag):
+        """添加导航栏，返回导航栏所在的body标签"""
+        nav_html = self._navigation_html(base_url)
+
         if body_tag:
             body_style = body_tag.get('style', '')
             if 'margin-top' not in body_style:
@@ -190,79 +707,128 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
                 if content.name != 'body':
                     body_tag.append(content)
             soup.append(body_tag)
+        return body_tag
 
-    def _rewrite_all_links(self, soup, base_url):
-        """重写所有链接和资源"""
-        # 重写普通链接 - 跳过有data-no-proxy标记的链接
-        for tag in soup.find_all('a', href=True):
-            if tag.get('data-no-proxy') == 'true':
-                continue
-                
-            href = tag['href']
-            if self._should_rewrite_url(href):
-                absolute_url = urllib.parse.urljoin(base_url, href)
-                tag['href'] = "/proxy?url=" + urllib.parse.quote(absolute_url)
-
-        # 重写表单
-        for form in soup.find_all('form', action=True):
-            action = form['action']
-            if self._should_rewrite_url(action):
-                absolute_url = urllib.parse.urljoin(base_url, action)
-                form['action'] = "/proxy?url=" + urllib.parse.quote(absolute_url)
-
-        # 重写所有资源
-        resource_tags = soup.find_all(['img', 'script', 'link', 'iframe', 'source', 'embed', 'object'], 
-                                    src=True) + soup.find_all('link', href=True)
-        
-        for tag in resource_tags:
-            src_attr = 'src' if tag.get('src') else 'href'
-            src = tag[src_attr]
-            if self._should_rewrite_url(src):
-                absolute_url = urllib.parse.urljoin(base_url, src)
-                tag[src_attr] = "/proxy?url=" + urllib.parse.quote(absolute_url)
-
-        # 重写CSS中的URL
-        style_tags = soup.find_all('style')
-        for style_tag in style_tags:
-            if style_tag.string:
-                style_tag.string = self._rewrite_css_urls(style_tag.string, base_url)
-
-        # 重写内联样式
-        for tag in soup.find_all(style=True):
-            style = tag['style']
+    def _apply_rewrite_rules(self, soup, base_url):
+        """遍历一次文档树，按标签名对每个标签执行注册的重写规则
+
+        站点专用规则先于通用规则执行，规则返回False表示标签已被移除。
+        返回遍历时遇到的第一个head和body标签。
+        """
+        site_rules = [rules for site, rules in self.site_rewrite_rules.items() if site in base_url]
+        dispatch = {}
+        landmarks = {}
+        for tag in soup.find_all(True):
+            name = tag.name
+            rules = dispatch.get(name)
+            if rules is None:
+                names = [rule for rules_by_tag in site_rules for rule in rules_by_tag.get(name, ())]
+                names += self.rewrite_rules.get(name, ()) + self.rewrite_rules['*']
+                rules = dispatch[name] = [getattr(self, rule) for rule in names]
+            if name in ('head', 'body'):
+                landmarks.setdefault(name, tag)
+            for rule in rules:
+                if rule(tag, base_url) is False:
+                    break
+        return landmarks.get('head'), landmarks.get('body')
+
+    def _proxy_url(self, url, base_url):
+        """把页面中的URL改写为经过代理的地址"""
+        if not self._should_rewrite_url(url):
+            return url
+        return UrlRewriteCache.shared(self.config).proxy_url(base_url, url)
+
+    def _rewrite_meta_refresh(self, content, base_url):
+        """重写meta refresh中的跳转地址"""
+        match = self.meta_refresh_pattern.match(content)
+        if not match:
+            return content
+        return match.group(1) + self._proxy_url(match.group(3), base_url)
+
+    def _is_charset_meta(self, attrs):
+        """判断meta标签是否声明了字符集，页面统一转为UTF-8输出，原有声明需要移除"""
+        return 'charset' in attrs or (attrs.get('http-equiv') or '').lower() == 'content-type'
+
+    def _rule_link(self, tag, base_url):
+        """重写普通链接，跳过有data-no-proxy标记的链接"""
+        href = tag.get('href')
+        if href and tag.get('data-no-proxy') != 'true':
+            tag['href'] = self._proxy_url(href, base_url)
+
+    def _rule_form(self, tag, base_url):
+        """重写表单提交地址"""
+        action = tag.get('action')
+        if action:
+            tag['action'] = self._proxy_url(action, base_url)
+
+    def _rule_resource(self, tag, base_url):
+        """重写资源地址，link标签没有src时使用href"""
+        src_attr = 'src' if tag.get('src') else 'href' if tag.name == 'link' else None
+        if src_attr and tag.get(src_attr):
+            tag[src_attr] = self._proxy_url(tag[src_attr], base_url)
+            if tag.name == 'script' or (tag.name == 'link' and 'stylesheet' in tag.get('rel', [])):
+                self._collect_preload_hint(tag.name, tag[src_attr])
+
+    def _rule_style_sheet(self, tag, base_url):
+        """重写style标签中的url()"""
+        if tag.string:
+            tag.string = self._rewrite_css_urls(tag.string, base_url)
+
+    def _rule_inline_style(self, tag, base_url):
+        """重写内联样式中的url()"""
+        style = tag.get('style')
+        if style:
             tag['style'] = self._rewrite_css_urls(style, base_url)
 
-    def _fix_bilibili_issues(self, soup):
-        """修复哔哩哔哩问题"""
-        # 修复412错误：移除可能导致验证的脚本
-        for script in soup.find_all('script'):
-            script_content = script.string or ''
-            if '412' in script_content or 'precondition' in script_content.lower():
-                script.decompose()
-        
-        # 确保资源正确加载
-        for link in soup.find_all('link', rel='stylesheet'):
-            if link.get('href'):
-                link['href'] = link['href'] + '?t=' + str(int(time.time()))
-        
-        for script in soup.find_all('script', src=True):
-            if script['src'] and not script['src'].startswith('http'):
-                script['src'] = 'https:' + script['src'] if script['src'].startswith('//') else 'https://www.bilibili.com' + script['src']
+    def _rule_meta(self, tag, base_url):
+        """重写meta refresh，移除原有的字符集声明"""
+        if self._is_charset_meta(tag.attrs):
+            tag.decompose()
+            return False
+        content = tag.get('content')
+        if content and (tag.get('http-equiv') or '').lower() == 'refresh':
+            tag['content'] = self._rewrite_meta_refresh(content, base_url)
 
-    def _inject_interception_script(self, soup):
-        """注入拦截脚本"""
-        interception_script = '''
+    def _rule_bilibili_script(self, tag, base_url):
+        """修复哔哩哔哩412错误：移除可能导致验证的脚本，补全相对脚本地址"""
+        script_content = tag.string or ''
+        if '412' in script_content or 'precondition' in script_content.lower():
+            tag.decompose()
+            return False
+        src = tag.get('src')
+        if src and not src.startswith('http'):
+            tag['src'] = 'https:' + src if src.startswith('//') else 'https://www.bilibili.com' + src
+
+    def _rule_bilibili_stylesheet(self, tag, base_url):
+        """哔哩哔哩样式表加时间戳，确保资源正确加载"""
+        if 'stylesheet' in tag.get('rel', []) and tag.get('href'):
+            tag['href'] = tag['href'] + '?t=' + str(int(time.time()))
+
+    interception_script_source = '''
         // 修复的JavaScript拦截代码
         (function() {
             'use strict';
             
+            // 原页面地址由script标签的data-base-url属性传入，用于解析相对链接
+            var script = document.currentScript;
+            var baseUrl = (script && script.getAttribute('data-base-url')) || document.baseURI;
+            
+            function resolveUrl(url) {
+                try {
+                    return new URL(url, baseUrl).href;
+                } catch (err) {
+                    return url;
+                }
+            }
+            
             // 拦截所有点击事件
             function interceptClickEvent(e) {
                 var target = e.target;
                 
                 while (target && target !== document) {
                     if (target.tagName && target.tagName.toLowerCase() === 'a' && target.href) {
-                        var href = target.href;
+                        var rawHref = target.getAttribute('href') || '';
+                        var href = resolveUrl(rawHref);
                         
                         // 检查是否是需要代理的链接 - 跳过有data-no-proxy标记的链接
                         if (href && 
@@ -270,7 +836,7 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
                             !href.startsWith('javascript:') && 
                             !href.startsWith('mailto:') && 
                             !href.startsWith('tel:') && 
-                            !href.startsWith('#') &&
+                            !rawHref.startsWith('#') &&
                             !href.startsWith('data:') &&
                             !target.hasAttribute('data-no-proxy')) {
                             
@@ -279,7 +845,8 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
                             e.stopPropagation();
                             
                             try {
-                                var proxyUrl = '/proxy?url=' + encodeURIComponent(href);
+                                // 用代理自身的地址拼出绝对路径，页面带<base href>时相对路径会指向原站
+                                var proxyUrl = location.origin + '/proxy?url=' + encodeURIComponent(href);
                                 window.location.href = proxyUrl;
                             } catch (err) {
                                 console.log('拦截错误:', err);
@@ -298,11 +865,11 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
             // 拦截表单提交
             document.addEventListener('submit', function(e) {
                 var form = e.target;
-                if (form.tagName && form.tagName.toLowerCase() === 'form' && form.action) {
-                    var action = form.action;
+                if (form.tagName && form.tagName.toLowerCase() === 'form' && form.getAttribute('action')) {
+                    var action = resolveUrl(form.getAttribute('action'));
                     if (action && !action.includes('/proxy?url=')) {
                         e.preventDefault();
-                        var proxyUrl = '/proxy?url=' + encodeURIComponent(action);
+                        var proxyUrl = location.origin + '/proxy?url=' + encodeURIComponent(action);
                         
                         // 创建隐藏表单进行提交
                         var hiddenForm = document.createElement('form');
@@ -332,19 +899,47 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
             console.log('拦截脚本已加载');
         })();
         '''
+
+    _interception_asset = None
+
+    @classmethod
+    def _interception_script_asset(cls):
+        """拦截脚本作为独立静态资源：(路径, 脚本字节, gzip字节, ETag)
+
+        路径中带内容哈希，脚本改动后路径随之变化，因此可以让浏览器永久缓存。
+        """
+        if cls._interception_asset is None:
+            body = cls.interception_script_source.encode('utf-8')
+            digest = hashlib.sha256(body).hexdigest()[:16]
+            cls._interception_asset = (f'/__proxy/intercept.{digest}.js', body,
+                                       gzip.compress(body, mtime=0), f'"{digest}"')
+        return cls._interception_asset
+
+    def _interception_script_tag(self, base_url, inline=False):
+        """引用拦截脚本的标签，原页面地址通过data-base-url传给脚本
+
+        inline为True时直接内嵌脚本内容，用于带<base href>的页面：
+        此时相对路径会按原站解析，引用代理上的脚本会请求到原站。
+        """
+        if inline:
+            return f'<script data-base-url="{html.escape(base_url)}">{self.interception_script_source}</script>'
+        path = self._interception_script_asset()[0]
+        return f'<script src="{path}" data-base-url="{html.escape(base_url)}"></script>'
+
+    def _inject_interception_script(self, soup, body_tag, base_url):
+        """注入拦截脚本"""
+        script_tag = soup.new_tag('script', attrs={
+            'src': self._interception_script_asset()[0],
+            'data-base-url': base_url,
+        })
         
-        script_tag = soup.new_tag('script')
-        script_tag.string = interception_script
-        
-        body_tag = soup.find('body')
         if body_tag:
             body_tag.append(script_tag)
         else:
             soup.append(script_tag)
 
-    def _ensure_charset(self, soup):
+    def _ensure_charset(self, soup, head_tag):
         """确保字符集声明"""
-        head_tag = soup.find('head')
         if not head_tag:
             head_tag = soup.new_tag('head')
             soup.insert(0, head_tag)
@@ -368,13 +963,14 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
 
     def _rewrite_css_urls(self, css_content, base_url):
         """重写CSS中的url()引用"""
+        url_cache = UrlRewriteCache.shared(self.config)
+
         def replace_url(match):
             url_content = match.group(1)
             if url_content.startswith(('http://', 'https://', 'data:')):
                 return match.group(0)
 
-            absolute_url = urllib.parse.urljoin(base_url, url_content.strip('"\''))
-            proxy_url = "/proxy?url=" + urllib.parse.quote(absolute_url)
+            proxy_url = url_cache.proxy_url(base_url, url_content.strip('"\''))
             return 'url("' + proxy_url + '")'
 
         pattern = r'url\(["\']?([^"\'()]*)["\']?\)'
@@ -412,15 +1008,15 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
                 </html>
                 '''
                 
-                self.send_response(200)
-                self.send_header('Content-Type', 'text/html; charset=utf-8')
-                self.send_header('Content-Length', str(len(redirect_html.encode('utf-8'))))
-                self.end_headers()
-                self.wfile.write(redirect_html.encode('utf-8'))
+                self._send_html_response(redirect_html.encode('utf-8'))
                 return
         
         # 处理其他错误状态码
-        error_html = f'''
+        self._send_html_response(self._generate_error_html(status_code, target_url).encode('utf-8'))
+
+    def _generate_error_html(self, status_code, target_url, message='目标网站返回了错误响应。'):
+        """生成错误页面HTML"""
+        return f'''
         <!DOCTYPE html>
         <html>
         <head>
@@ -439,18 +1035,17 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
             <div class="error-container">
                 <h1>代理访问遇到问题</h1>
                 <div>错误代码: {status_code}</div>
-                <p>目标网站返回了错误响应。</p>
+                <p>{html.escape(message)}</p>
                 <p><a href="/proxy?url={urllib.parse.quote(target_url)}">重新尝试访问此页面</a></p>
             </div>
         </body>
         </html>
         '''
-        
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.send_header('Content-Length', str(len(error_html.encode('utf-8'))))
-        self.end_headers()
-        self.wfile.write(error_html.encode('utf-8'))
+
+    def _send_circuit_open(self, error, target_url):
+        """上游主机熔断时直接返回错误页面，不等待上游超时"""
+        message = f'{error} 目标网站近期持续出错或响应过慢，请稍后再试。'
+        self._send_html_response(self._generate_error_html(503, target_url, message).encode('utf-8'), status=503)
 
     def _handle_search_result(self):
         """处理搜索结果 - 修复必应变360问题"""
@@ -522,23 +1117,28 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
         headers = self._get_headers(target_url)
         
         try:
-            response = requests.get(target_url, headers=headers, timeout=self.config['timeout'], verify=False)
+            response = self._upstream_request('get', target_url, self.config['read_timeout'], headers=headers,
+                                              verify=False, stream=True)
+        except CircuitOpenError as e:
+            self._send_circuit_open(e, target_url)
+            return
+        except DeadlineExceeded as e:
+            self.send_error(504, str(e))
+            return
         except requests.exceptions.RequestException as e:
             self.send_error(502, f"Failed to fetch: {str(e)}")
             return
         
-        if response.status_code != 200:
+        # 206/416是对Range请求的响应，直接转发
+        if response.status_code not in (200, 206, 416):
+            response.close()
             self._handle_response_error(response, target_url)
             return
         
         content_type = response.headers.get('Content-Type', '').lower()
-        if 'text/html' in content_type:
-            rewritten_content = self._rewrite_html(response.text, target_url)
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html; charset=utf-8')
-            self.send_header('Content-Length', str(len(rewritten_content.encode('utf-8'))))
-            self.end_headers()
-            self.wfile.write(rewritten_content.encode('utf-8'))
+        if 'text/html' in content_type and response.status_code == 200:
+            self._send_html_response(self._rewrite_response(response, target_url),
+                                     flush_first=self.config['html_early_flush'])
         else:
             self._proxy_raw_content(response)
 
@@ -558,10 +1158,11 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
         headers['Content-Type'] = self.headers.get('Content-Type', 'application/x-www-form-urlencoded')
         
         try:
-            response = requests.post(target_url, data=post_data, headers=headers, 
-                                   timeout=self.config['timeout'], verify=False, allow_redirects=False)
+            response = self._upstream_request('post', target_url, self.config['read_timeout'], data=post_data,
+                                              headers=headers, verify=False, allow_redirects=False, stream=True)
             
             if response.status_code in [301, 302, 303, 307, 308]:
+                response.close()
                 location = response.headers.get('Location', '')
                 if location:
                     if not location.startswith(('http://', 'https://')):
@@ -588,28 +1189,25 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
                     </html>
                     '''
                     
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'text/html; charset=utf-8')
-                    self.send_header('Content-Length', str(len(redirect_html.encode('utf-8'))))
-                    self.end_headers()
-                    self.wfile.write(redirect_html.encode('utf-8'))
+                    self._send_html_response(redirect_html.encode('utf-8'))
                     return
             
             if response.status_code != 200:
+                response.close()
                 self._handle_response_error(response, target_url)
                 return
                 
             content_type = response.headers.get('Content-Type', '').lower()
             if 'text/html' in content_type:
-                rewritten_content = self._rewrite_html(response.text, target_url)
-                self.send_response(200)
-                self.send_header('Content-Type', 'text/html; charset=utf-8')
-                self.send_header('Content-Length', str(len(rewritten_content.encode('utf-8'))))
-                self.end_headers()
-                self.wfile.write(rewritten_content.encode('utf-8'))
+                self._send_html_response(self._rewrite_response(response, target_url),
+                                         flush_first=self.config['html_early_flush'])
             else:
                 self._proxy_raw_content(response)
             
+        except CircuitOpenError as e:
+            self._send_circuit_open(e, target_url)
+        except DeadlineExceeded as e:
+            self.send_error(504, str(e))
         except requests.exceptions.RequestException as e:
             self.send_error(502, f"Failed to POST: {str(e)}")
 
@@ -685,11 +1283,7 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
         </html>
         '''
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.send_header('Content-Length', str(len(homepage_html.encode('utf-8'))))
-        self.end_headers()
-        self.wfile.write(homepage_html.encode('utf-8'))
+        self._send_html_response(homepage_html.encode('utf-8'))
 
     def _proxy_resource(self):
         """代理资源文件"""
@@ -706,20 +1300,32 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
                     return
                     
                 resource_url = urllib.parse.urljoin(base_url, self.path)
+                self._deadline = self._deadline.child(self.config['resource_deadline'])
 
                 headers = {
                     'User-Agent': self.config['user_agent'],
                     'Referer': base_url
                 }
+                self._forward_range_headers(headers)
+                self._forward_validators(headers)
+
+                handled, stale_entry = self._try_caches(resource_url, headers)
+                if handled:
+                    return
+                if self._negative_cache().lookup(resource_url):
+                    self._send_empty_response()
+                    return
 
+                key = self._coalesce_key('resource', resource_url, headers) if stale_entry is None else None
                 try:
-                    response = requests.get(resource_url, headers=headers, timeout=15, verify=False)
-                    if response.status_code == 200:
-                        self._proxy_raw_content(response)
+                    shared, send = self._fetch_coalesced(
+                        key, lambda shareable: self._fetch_resource(resource_url, headers, stale_entry, shareable))
+                    if shared is not None:
+                        self._send_shared_response(shared, lambda result: self._send_empty_response())
                     else:
-                        self._send_empty_response()
+                        send()
                     return
-                except requests.exceptions.RequestException:
+                except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError):
                     self._send_empty_response()
                     return
 
@@ -729,6 +1335,156 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
             
         self._send_empty_response()
 
+    def _fetch_resource(self, resource_url, headers, stale_entry=None, shareable=False):
+        """访问上游资源，返回值与_fetch_page相同"""
+        try:
+            response = self._upstream_request('get', resource_url, self.config['resource_read_timeout'],
+                                              headers=headers, verify=False, stream=True)
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
+        except requests.exceptions.RequestException as e:
+            self._negative_cache().record_error(resource_url, e)
+            raise
+        if response.status_code == 304 and stale_entry:
+            return None, lambda: self._serve_revalidated_entry(stale_entry, response)
+        if response.status_code not in (200, 206, 416):
+            response.close()
+            self._negative_cache().record_status(resource_url, response.status_code)
+            return _SharedResponse(response.status_code, response.headers), None
+        return self._share_raw_content(response, resource_url, shareable)
+
+    def _negative_cache(self):
+        """获取访问失败记录"""
+        return NegativeCache.shared(self.config)
+
+    def _is_navigation(self):
+        """判断当前请求是否是用户打开页面，而不是页面中的资源
+
+        优先使用Sec-Fetch-Mode；没有该请求头的旧浏览器按Accept是否包含text/html判断。
+        """
+        mode = self.headers.get('Sec-Fetch-Mode')
+        if mode:
+            return mode == 'navigate'
+        return 'text/html' in self.headers.get('Accept', '')
+
+    def _coalesce_key(self, kind, url, headers):
+        """合并请求的键：请求类型、方法、URL和发往上游的全部请求头
+
+        上游请求头相同则上游响应的Vary变体也相同；客户端压缩协商在发送时单独处理。
+        Range请求的结果因客户端而异，不参与合并。
+        """
+        if not self.config['request_coalescing'] or 'Range' in headers:
+            return None
+        return (kind, 'GET', url, tuple(sorted(headers.items())))
+
+    def _fetch_coalesced(self, key, fetch):
+        """相同的请求同时只访问一次上游，返回(共享结果, 发送函数)
+
+        fetch(shareable)执行实际的上游访问。领头请求的结果无法共享或等待超时时，
+        跟随的请求自行访问上游；领头请求的异常会在所有跟随的请求中重新抛出。
+        """
+        if key is None:
+            return fetch(False)
+        deadline = self._deadline or Deadline()
+        shared, send = RequestCoalescer.shared(self.config).run(key, lambda: fetch(True),
+                                                                 timeout=deadline.remaining())
+        if shared is None and send is None:
+            deadline.check('coalesce_wait')
+            return fetch(False)
+        return shared, send
+
+    def _share_raw_content(self, response, cache_key, shareable):
+        """长度已知的小资源整体读入内存作为共享结果，其余边读边转发"""
+        length = response.headers.get('Content-Length', '')
+        encoding = response.headers.get('Content-Encoding', 'identity').strip().lower()
+        if encoding in ('', 'identity'):
+            encoding = None
+        if (not shareable or response.status_code != 200 or not length.isdigit()
+                or int(length) > self.config['coalesce_max_bytes']
+                or (encoding and encoding not in _CacheEntry.decodable_encodings())):
+            return None, lambda: self._proxy_raw_content(response, cache_key=cache_key)
+
+        # 压缩的内容原样保存，发送时按客户端是否支持决定是否解压
+        watch = (self._deadline or Deadline()).watch(response)
+        try:
+            body = response.raw.read(decode_content=False) if encoding else response.content
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            if watch.fired:
+                raise Deadline.exceed('body') from e
+            raise
+        finally:
+            watch.cancel()
+            response.close()
+        cache = self._cache()
+        if cache.is_cacheable(response):
+            cache.store(cache_key, response, body, encoding)
+        return _SharedResponse(200, response.headers, entry=cache.make_entry(response, body, encoding)), None
+
+    def _send_shared_response(self, shared, send_error):
+        """发送合并请求共享的结果，上游错误状态交给send_error处理"""
+        if shared.html is not None:
+            self._send_html_response(shared.html)
+        elif shared.entry is not None:
+            self._send_cached_response(shared.entry)
+        elif shared.status_code == 304:
+            # 转发了客户端的验证器，上游确认客户端的副本仍然有效
+            self._send_not_modified(shared.headers.items())
+        else:
+            send_error(shared)
+
+    def _serve_stats(self):
+        """输出服务器运行统计(JSON)"""
+        stats = {
+            'server': self.server.stats(),
+            'upstream_pool': self._upstream().stats(),
+            'memory_cache': self._cache().stats(),
+            'disk_cache': self._disk_cache().stats(),
+            'html_parser': ParserBackend.shared(self.config).stats(),
+            'url_cache': UrlRewriteCache.shared(self.config).stats(),
+            'rewrite_pool': RewritePool.shared(self.config).stats(),
+            'preload_history': PreloadHistory.shared(self.config).stats(),
+            'charset': CharsetDetector.shared(self.config).stats(),
+            'coalescing': RequestCoalescer.shared(self.config).stats(),
+            'negative_cache': self._negative_cache().stats(),
+            'circuit_breaker': CircuitBreaker.shared(self.config).stats(),
+            'deadlines': dict(Deadline.stats(), **{name: self.config[name] for name in (
+                'connect_timeout', 'read_timeout', 'resource_read_timeout', 'request_deadline', 'resource_deadline')}),
+        }
+        supervisor = getattr(self.server, 'supervisor', None)
+        if supervisor:
+            stats['processes'] = supervisor.stats()
+        body = json.dumps(stats, ensure_ascii=False, indent=2).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _serve_interception_script(self):
+        """输出拦截脚本，内容不变时路径不变，允许浏览器永久缓存"""
+        path, body, gzipped, etag = self._interception_script_asset()
+        if urllib.parse.urlparse(self.path).path != path:
+            self.send_error(404, "Not Found")
+            return
+        cache_control = 'public, max-age=31536000, immutable'
+        if self._client_has_fresh_copy(etag, None):
+            self._send_not_modified([('ETag', etag), ('Cache-Control', cache_control)])
+            return
+        encoding = 'gzip' if self._client_accepts_encoding('gzip') else None
+        if encoding:
+            body = gzipped
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/javascript; charset=utf-8')
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def _send_empty_response(self):
         """发送空响应"""
         self.send_response(200)
@@ -736,35 +1492,2923 @@ class FixedProxyHandler(http.server.BaseHTTPRequestHandler):
         self.send_header('Content-Length', '0')
         self.end_headers()
 
-    def _proxy_raw_content(self, response):
-        """代理原始内容"""
+    def _cache(self):
+        """获取共享的静态资源缓存"""
+        return ResponseCache.shared(self.config)
+
+    def _proxy_raw_content(self, response, cache_key=None):
+        """代理原始内容 - 按固定大小分块流式转发，不在内存中缓存整个响应体
+
+        指定cache_key且响应可缓存时，同时把转发的内容保存到内存缓存。
+        """
         self.send_response(response.status_code)
         
-        excluded_headers = ['content-encoding', 'transfer-encoding', 'content-length', 'connection']
+        excluded_headers = ['content-encoding', 'transfer-encoding', 'content-length', 'connection', 'vary']
         for header, value in response.headers.items():
             if header.lower() not in excluded_headers:
                 self.send_header(header, value)
-        
-        self.send_header('Content-Length', str(len(response.content)))
+
+        # 内容不需要重写，客户端支持上游的压缩格式时原样转发压缩数据；
+        # 否则由requests解压，此时上游的长度与转发的字节数不一致
+        content_length = response.headers.get('Content-Length')
+        content_encoding = response.headers.get('Content-Encoding', 'identity').strip().lower()
+        compressed = content_encoding not in ('', 'identity')
+        passthrough = compressed and self._client_accepts_encoding(content_encoding)
+        vary = response.headers.get('Vary', '')
+        if compressed and 'accept-encoding' not in vary.lower():
+            vary = vary + ', Accept-Encoding' if vary else 'Accept-Encoding'
+        if vary:
+            self.send_header('Vary', vary)
+
+        chunked = False
+        if passthrough:
+            self.send_header('Content-Encoding', response.headers['Content-Encoding'])
+        if content_length and (passthrough or not compressed):
+            self.send_header('Content-Length', content_length)
+        elif self.request_version == 'HTTP/1.1':
+            self.send_header('Transfer-Encoding', 'chunked')
+            chunked = True
+        else:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+        cache = self._cache()
+        stored = [] if cache_key and cache.is_cacheable(response) else None
+        stored_size = 0
+        disk_writer = None
+        if cache_key and not (compressed and passthrough):
+            disk_writer = self._disk_cache().open_writer(cache_key, response)
+        chunk_size = self.config['stream_chunk_size']
+        try:
+            if passthrough:
+                chunks = response.raw.stream(chunk_size, decode_content=False)
+            else:
+                chunks = response.iter_content(chunk_size=chunk_size)
+            for chunk in chunks:
+                if chunk:
+                    self._write_body(chunk, chunked)
+                    if disk_writer:
+                        disk_writer.write(chunk)
+                    if stored is not None:
+                        stored.append(chunk)
+                        stored_size += len(chunk)
+                        if stored_size > cache.max_entry_bytes:
+                            stored = None
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+            if stored is not None:
+                cache.store(cache_key, response, b''.join(stored),
+                            content_encoding if passthrough else None)
+            if disk_writer:
+                disk_writer.commit()
+                disk_writer = None
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            # 响应头已经发出，只能断开连接让客户端知道内容不完整
+            print(f"转发中断: {e}")
+            self.close_connection = True
+        finally:
+            if disk_writer:
+                disk_writer.abort()
+            response.close()
+
+    def _disk_cache(self):
+        """获取大文件磁盘缓存"""
+        return DiskCache.shared(self.config)
+
+    def _try_caches(self, url, headers):
+        """依次查找内存缓存和磁盘缓存，返回值与_try_disk_cache相同"""
+        handled, stale_entry = self._try_memory_cache(url, headers)
+        if handled or stale_entry is not None:
+            return handled, stale_entry
+        return self._try_disk_cache(url, headers)
+
+    def _try_memory_cache(self, url, headers):
+        """查找内存缓存
+
+        条目仍然新鲜时直接发送并返回(True, 条目)；只有带验证器的过期条目时把验证器加到
+        上游请求头，返回(False, 条目)，上游回复304时刷新并继续使用该条目。
+        """
+        cache = self._cache()
+        entry = cache.lookup(url, headers)
+        if entry:
+            self._send_cached_response(entry)
+            return True, entry
+        entry = cache.lookup_stale(url, headers)
+        if entry is None:
+            return False, None
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return False, entry
+
+    def _try_disk_cache(self, url, headers):
+        """查找磁盘缓存
+
+        条目仍然新鲜时直接发送并返回(True, 条目)；已过期时把验证器加到上游请求头，
+        返回(False, 条目)，上游回复304时继续使用该条目。
+        """
+        entry = self._disk_cache().lookup(url)
+        if entry is None:
+            return False, None
+        if entry.is_fresh():
+            self._send_disk_cached_response(entry)
+            return True, entry
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return False, entry
+
+    def _serve_revalidated_entry(self, entry, response):
+        """上游确认缓存条目仍然有效(304)后发送缓存内容"""
+        response.close()
+        if isinstance(entry, _CacheEntry):
+            self._cache().refresh(entry, response.headers)
+            self._send_cached_response(entry)
+        else:
+            self._disk_cache().refresh(entry, response.headers)
+            self._send_disk_cached_response(entry)
+
+    def _send_disk_cached_response(self, entry):
+        """发送磁盘缓存的文件，线程池引擎下使用sendfile零拷贝发送"""
+        try:
+            blob = open(entry.blob_path, 'rb')
+        except OSError:
+            self.send_error(503, "Cache entry unavailable")
+            return
+        with blob:
+            if self._client_has_fresh_copy(entry.etag, entry.last_modified):
+                self._send_not_modified(entry.headers)
+                return
+            size = os.fstat(blob.fileno()).st_size
+            start, end = 0, size - 1
+            status = 200
+            range_header = self.headers.get('Range')
+            if range_header and self._if_range_matches(entry):
+                byte_range = self._parse_byte_range(range_header, size)
+                if byte_range == 'unsatisfiable':
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if byte_range:
+                    start, end = byte_range
+                    status = 206
+
+            self.send_response(status)
+            for header, value in entry.headers:
+                self.send_header(header, value)
+            self.send_header('Accept-Ranges', 'bytes')
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            if size == 0:
+                return
+
+            count = end - start + 1
+            if self.connection is not None:
+                self.connection.sendfile(blob, offset=start, count=count)
+            else:
+                with mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    chunk_size = self.config['stream_chunk_size']
+                    for offset in range(start, end + 1, chunk_size):
+                        self.wfile.write(view[offset:min(offset + chunk_size, end + 1)])
+                    view.release()
+            self._disk_cache().record_served(count)
+
+    def _send_cached_response(self, entry):
+        """从缓存条目发送响应，支持单个字节范围的Range请求"""
+        if self._client_has_fresh_copy(entry.etag, entry.last_modified):
+            vary = [('Vary', entry.vary_header)] if entry.vary_header else []
+            self._send_not_modified(entry.headers + vary)
+            return
+        body = entry.body
+        encoding = entry.content_encoding
+        if encoding and not self._client_accepts_encoding(encoding):
+            body = entry.decoded_body()
+            encoding = None
+
+        status = 200
+        content_range = None
+        range_header = self.headers.get('Range')
+        if range_header and not encoding and self._if_range_matches(entry):
+            byte_range = self._parse_byte_range(range_header, len(body))
+            if byte_range is None:
+                pass
+            elif byte_range == 'unsatisfiable':
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            else:
+                start, end = byte_range
+                status = 206
+                content_range = f'bytes {start}-{end}/{len(body)}'
+                body = body[start:end + 1]
+
+        self.send_response(status)
+        for header, value in entry.headers:
+            self.send_header(header, value)
+        self.send_header('Age', str(entry.age()))
+        self.send_header('Accept-Ranges', 'bytes')
+        if entry.content_encoding:
+            vary = entry.vary_header
+            if 'accept-encoding' not in vary.lower():
+                vary = vary + ', Accept-Encoding' if vary else 'Accept-Encoding'
+            self.send_header('Vary', vary)
+        elif entry.vary_header:
+            self.send_header('Vary', entry.vary_header)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _client_has_fresh_copy(self, etag, last_modified):
+        """按客户端的If-None-Match/If-Modified-Since判断能否回复304
+
+        有If-None-Match时只按弱比较匹配ETag，忽略If-Modified-Since。
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            if if_none_match.strip() == '*':
+                return True
+            if not etag:
+                return False
+            opaque = etag[2:] if etag.startswith('W/') else etag
+            for tag in if_none_match.split(','):
+                tag = tag.strip()
+                if (tag[2:] if tag.startswith('W/') else tag) == opaque:
+                    return True
+            return False
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and last_modified:
+            try:
+                return (email.utils.parsedate_to_datetime(last_modified)
+                        <= email.utils.parsedate_to_datetime(if_modified_since))
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _send_not_modified(self, headers):
+        """回复304，只保留与缓存验证相关的响应头"""
+        self.send_response(304)
+        for header, value in headers:
+            if header.lower() in self.not_modified_headers:
+                self.send_header(header, value)
+        self.end_headers()
+
+    def _if_range_matches(self, entry):
+        """If-Range与缓存条目的验证器一致时才按范围返回"""
+        if_range = self.headers.get('If-Range')
+        if not if_range:
+            return True
+        if if_range.startswith(('"', 'W/')):
+            return not if_range.startswith('W/') and if_range == entry.etag
+        return if_range == entry.last_modified
+
+    def _parse_byte_range(self, range_header, size):
+        """解析单个字节范围，返回(start, end)；多段或格式错误返回None"""
+        unit, _, ranges = range_header.partition('=')
+        if unit.strip().lower() != 'bytes' or ',' in ranges:
+            return None
+        start, _, end = ranges.strip().partition('-')
+        try:
+            if start:
+                start = int(start)
+                end = min(int(end), size - 1) if end else size - 1
+            elif end:
+                start = max(size - int(end), 0)
+                end = size - 1
+            else:
+                return None
+        except ValueError:
+            return None
+        if start >= size or start > end:
+            return 'unsatisfiable'
+        return start, end
+
+    def _choose_compression(self):
+        """根据客户端Accept-Encoding选择HTML响应的压缩格式"""
+        if not self.config['html_compression']:
+            return None
+        if brotli is not None and self._client_accepts_encoding('br'):
+            return 'br'
+        if self._client_accepts_encoding('gzip'):
+            return 'gzip'
+        return None
+
+    def _send_html_response(self, chunks, status=200, flush_first=False):
+        """发送HTML响应
+
+        chunks为UTF-8字节串或字节块的可迭代对象。内容不足最小压缩大小时整体发送；
+        否则在客户端支持时边生成边压缩，并以分块传输发送。flush_first为True时
+        不等待缓冲，第一块生成后立即连同响应头发出。
+        """
+        encoding = self._choose_compression()
+        etag = None
+        if isinstance(chunks, bytes):
+            if status == 200:
+                # 完整的页面按重写后的内容生成强ETag，压缩后的表示带上压缩格式以示区别
+                compressed = encoding and len(chunks) >= self.config['compression_min_size']
+                etag = '"h-' + hashlib.sha256(chunks).hexdigest()[:24] + ('-' + encoding if compressed else '') + '"'
+                if self._client_has_fresh_copy(etag, None):
+                    self._send_not_modified([('ETag', etag), ('Cache-Control', 'no-cache'),
+                                             ('Vary', 'Accept-Encoding')])
+                    return
+            chunks = (chunks,)
+        chunks = iter(chunks)
+
+        # 先缓冲到最小压缩大小，以便小页面仍然带Content-Length整体发送
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if flush_first or size >= self.config['compression_min_size']:
+                break
+        else:
+            body = b''.join(head)
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            if etag:
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+            if self.config['html_compression']:
+                self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        if self.config['html_compression']:
+            self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        chunked = self.request_version == 'HTTP/1.1'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
         self.end_headers()
-        self.wfile.write(response.content)
+
+        compressor = _BodyCompressor(encoding, self.config) if encoding else None
+        if flush_first and head:
+            # 立即送出第一块，不留在压缩器的缓冲区里
+            chunk = compressor.compress(head[0]) + compressor.flush() if compressor else head[0]
+            self._write_body(chunk, chunked)
+            head = head[1:]
+        for chunk in itertools.chain(head, chunks):
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                self._write_body(chunk, chunked)
+        if compressor:
+            tail = compressor.finish()
+            if tail:
+                self._write_body(tail, chunked)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def _client_accepts_encoding(self, encoding):
+        """判断客户端的Accept-Encoding是否接受指定的压缩格式"""
+        aliases = {'x-gzip': 'gzip', 'x-compress': 'compress'}
+        encoding = aliases.get(encoding, encoding)
+        wildcard = False
+        for item in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = item.partition(';')
+            name = aliases.get(name.strip().lower(), name.strip().lower())
+            quality = 1.0
+            for param in params.split(';'):
+                key, _, value = param.partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if name == encoding:
+                return quality > 0
+            if name == '*':
+                wildcard = quality > 0
+        return wildcard
+
+    def _write_body(self, data, chunked=False):
+        """写出响应体，chunked为True时按分块传输编码"""
+        if chunked:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def end_headers(self):
+        """服务引擎不支持长连接时明确告知客户端关闭连接"""
+        if not getattr(self.server, 'keep_alive', False) and not self.close_connection:
+            self.send_header('Connection', 'close')
+        super().end_headers()
 
     def log_message(self, format, *args):
         """自定义日志格式"""
         print("[" + self.log_date_time_string() + "] " + format % args)
 
-def run_proxy_server():
-    """运行代理服务器"""
-    port = 60000
-    
+class ParserBackend:
+    """BeautifulSoup解析器后端
+
+    auto时优先使用已安装的lxml，否则使用html.parser；html5lib最慢，只在明确配置时使用。
+    启动自检用一组样例页面比较候选解析器与html.parser的重写结果，不一致时回退到
+    html.parser，同时报告各解析器的解析耗时。运行中按解析器统计解析次数和耗时。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    # 解析器名称及其依赖的模块
+    modules = {'lxml': 'lxml', 'html.parser': None, 'html5lib': 'html5lib'}
+    auto_preference = ('lxml', 'html.parser')
+
+    fixture_base_url = 'https://example.com/dir/page.html'
+    fixtures = (
+        '''<!DOCTYPE html><html><head><meta charset="gbk"><title>样例 &amp; 测试</title>
+        <link rel="stylesheet" href="/css/a.css"><style>body { background: url(img/bg.png) }</style>
+        <meta http-equiv="refresh" content="10; url=/next"></head>
+        <body class="main"><a href="sub/page?a=1&amp;b=2">链接</a><a href="#top">锚点</a>
+        <img src="//cdn.example.com/i.png" alt="图"><form action="/search" method="get"><input name="q"></form>
+        <div style="background-image: url('x.png')">内容</div><script src="app.js"></script></body></html>''',
+        '''<div><p>没有html和body的片段<a href="http://other.example.org/">外链</a>
+        <iframe src="/embed"></iframe><a href="javascript:void(0)">脚本</a></div>''',
+        '''<html><head><meta http-equiv="Content-Type" content="text/html; charset=gb2312"></head>
+        <body><table><tr><td><a href="a.html">未闭合<td><img src="b.png"></table>
+        <p>段落<p>另一段<!-- 注释 --><source src="v.mp4"><embed src="f.swf"></body></html>''',
+    )
+
+    def __init__(self, requested='auto'):
+        self.requested = requested
+        self.name = None
+        self.self_test = {}
+        self._lock = threading.Lock()
+        self._timings = {}
+
+    @classmethod
+    def shared(cls, config):
+        """按配置获取当前进程的解析器后端"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls(config['html_parser'])
+        return cls._shared
+
+    @classmethod
+    def available(cls, name):
+        """解析器依赖的模块是否已安装"""
+        if name not in cls.modules:
+            return False
+        module = cls.modules[name]
+        return module is None or importlib.util.find_spec(module) is not None
+
+    def select(self):
+        """选择解析器并执行启动自检，返回选定的解析器名称"""
+        with self._lock:
+            if self.name:
+                return self.name
+            if self.requested == 'auto':
+                candidates = [name for name in self.auto_preference if self.available(name)]
+            elif self.available(self.requested):
+                candidates = [self.requested]
+            else:
+                print(f"解析器 {self.requested} 不可用，使用 html.parser")
+                candidates = []
+
+            self.self_test = self._run_self_test()
+            for name in candidates:
+                if self.self_test.get(name, {}).get('equivalent'):
+                    self.name = name
+                    break
+            else:
+                self.name = 'html.parser'
+            for name, result in self.self_test.items():
+                status = '一致' if result['equivalent'] else '不一致'
+                print(f"解析器 {name}: 重写结果{status}, 样例解析耗时 {result['parse_ms']} ms")
+            print(f"HTML解析器: {self.name}")
+            return self.name
+
+    def _run_self_test(self):
+        """对所有已安装的解析器重写样例页面，与html.parser的结果比较"""
+        handler = FixedProxyHandler.__new__(FixedProxyHandler)
+        results = {}
+        reference = None
+        for name in self.modules:
+            if not self.available(name):
+                continue
+            try:
+                signatures = []
+                start = time.perf_counter()
+                soups = [BeautifulSoup(fixture, name) for fixture in self.fixtures]
+                parse_ms = (time.perf_counter() - start) * 1000
+                for soup in soups:
+                    output = ''.join(handler._rewrite_soup(soup, self.fixture_base_url))
+                    signatures.append(self._rewrite_signature(output))
+            except Exception as e:
+                print(f"解析器 {name} 自检失败: {e}")
+                continue
+            if name == 'html.parser':
+                reference = signatures
+            results[name] = {'signatures': signatures, 'parse_ms': round(parse_ms, 2)}
+        for result in results.values():
+            result['equivalent'] = result.pop('signatures') == reference
+        return results
+
+    @staticmethod
+    def _rewrite_signature(output):
+        """提取重写结果中与代理相关的部分：改写过的属性、导航栏、脚本和字符集声明
+
+        不同解析器补全的标签结构可能不同，因此只比较这些内容是否一致。
+        """
+        soup = BeautifulSoup(output, 'html.parser')
+        values = []
+        for tag in soup.find_all(True):
+            for attr in ('href', 'src', 'action', 'style', 'content', 'charset'):
+                value = tag.get(attr)
+                if value:
+                    values.append((tag.name, attr, value))
+        return sorted(values), len(soup.find_all('script'))
+
+    @staticmethod
+    def prepare_markup(content, encoding, parser):
+        """准备交给解析器的页面内容
+
+        UTF-8页面交给lxml时直接传入字节，由libxml2边解析边解码，不生成整页字符串；
+        其他情况先解码。html.parser等解析器即使传入字节也会先整体解码，而且遇到
+        非法UTF-8字节时会改猜其他编码，因此不走字节路径。
+        """
+        if parser == 'lxml' and encoding in ('utf-8', 'utf-8-sig'):
+            return content
+        return _decode_html(content, encoding)
+
+    def parse(self, content, parser=None):
+        """解析HTML并记录耗时，content为字节时按UTF-8解析"""
+        name = parser or self.name or self.select()
+        start = time.perf_counter()
+        if isinstance(content, bytes):
+            soup = BeautifulSoup(content, name, from_encoding='utf-8')
+        else:
+            soup = BeautifulSoup(content, name)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            timing = self._timings.setdefault(name, [0, 0.0, 0, 0])
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] += len(content)
+            timing[3] += isinstance(content, bytes)
+        return soup
+
+    def stats(self):
+        """解析器统计"""
+        with self._lock:
+            parses = {}
+            for name, (count, elapsed, size, bytes_input) in self._timings.items():
+                parses[name] = {
+                    'count': count,
+                    'utf8_bytes_input': bytes_input,
+                    'total_ms': round(elapsed * 1000, 1),
+                    'avg_ms': round(elapsed * 1000 / count, 2) if count else 0.0,
+                    'mb_per_s': round(size / (1024 * 1024) / elapsed, 2) if elapsed else 0.0,
+                }
+            return {
+                'requested': self.requested,
+                'backend': self.name,
+                'self_test': self.self_test,
+                'parses': parses,
+            }
+
+
+def _rewrite_page_in_worker(content, encoding, base_url, config, parser, prelude_sent):
+    """进程池中执行的页面重写，返回(UTF-8结果, 预加载资源, 开始时间, 耗时)"""
+    started = time.time()
+    handler = FixedProxyHandler.__new__(FixedProxyHandler)
+    handler.config = config
+    handler._prelude_sent = prelude_sent
+    handler._preload_hints = [] if prelude_sent else None
+    markup = ParserBackend.prepare_markup(content, encoding, parser)
+    body = b''.join(chunk.encode('utf-8') for chunk in handler._rewrite_html_chunks(markup, base_url, parser))
+    return body, handler._preload_hints or [], started, time.time() - started
+
+
+def _decode_html(content, encoding):
+    """按检测到的编码解码整个页面，无法识别的编码按UTF-8处理"""
     try:
-        import urllib3
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-    except:
+        return content.decode(encoding or 'utf-8', errors='replace')
+    except LookupError:
+        return content.decode('utf-8', errors='replace')
+
+
+class RewritePool:
+    """大页面重写进程池
+
+    达到大小阈值的页面以原始字节和基准URL交给子进程重写，服务线程等待结果时
+    不占用GIL；小页面仍在当前线程重写。子进程用spawn方式启动，不继承服务
+    线程的状态。统计排队时间和工作进程利用率。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, processes=2, min_size=256 * 1024, timeout=30):
+        self.processes = processes
+        self.min_size = min_size
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.queue_time = 0.0
+        self.busy_time = 0.0
+
+    @classmethod
+    def shared(cls, config):
+        """按配置获取当前进程的重写进程池"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    # 请求的剩余预算在每次重写时另外传入，这里只是单次重写的上限
+                    cls._shared = cls(config['rewrite_processes'], config['rewrite_process_min_size'],
+                                      config['read_timeout'])
+        return cls._shared
+
+    def should_offload(self, size):
+        return self.processes > 0 and size >= self.min_size
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                self.started_at = time.time()
+            return self._executor
+
+    def rewrite(self, content, encoding, base_url, config, prelude_sent=False, timeout=None):
+        """在子进程中重写页面，返回(结果, 预加载资源)，失败时返回None由调用方在当前线程重写
+
+        timeout为调用方剩余的时间预算，与进程池自身的超时取较小值。
+        """
+        if timeout is not None and self.timeout is not None:
+            timeout = min(timeout, self.timeout)
+        elif timeout is None:
+            timeout = self.timeout
+        parser = ParserBackend.shared(config).select()
+        submitted = time.time()
+        with self._lock:
+            self.submitted += 1
+            self.in_flight += 1
+        try:
+            future = self._get_executor().submit(_rewrite_page_in_worker, content, encoding,
+                                                 base_url, dict(config), parser, prelude_sent)
+            body, hints, started, elapsed = future.result(timeout=timeout)
+        except Exception as e:
+            print(f"进程池重写失败，改为当前线程重写: {e!r}")
+            with self._lock:
+                self.failed += 1
+                self.in_flight -= 1
+                if isinstance(e, BrokenProcessPool):
+                    self._executor = None
+            return None
+        with self._lock:
+            self.completed += 1
+            self.in_flight -= 1
+            self.queue_time += max(0.0, started - submitted)
+            self.busy_time += elapsed
+        return body, hints
+
+    def stats(self):
+        """进程池统计"""
+        with self._lock:
+            uptime = max(time.time() - self.started_at, 1e-6)
+            return {
+                'processes': self.processes,
+                'min_size': self.min_size,
+                'running': self._executor is not None,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'in_flight': self.in_flight,
+                'avg_queue_ms': round(self.queue_time * 1000 / self.completed, 2) if self.completed else 0.0,
+                'avg_rewrite_ms': round(self.busy_time * 1000 / self.completed, 2) if self.completed else 0.0,
+                'utilization': round(self.busy_time / (uptime * self.processes), 3) if self.processes else 0.0,
+            }
+
+
+class CharsetDetector:
+    """分级检测页面编码
+
+    依次检查BOM、Content-Type头、页面开头的meta声明(字节级正则)、同一主机最近
+    的检测结果，最后才对有限长度的样本做统计检测，不再对整个页面运行chardet。
+    按级别统计命中次数。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    boms = (
+        (codecs.BOM_UTF8, 'utf-8-sig'),
+        (codecs.BOM_UTF32_LE, 'utf-32'),
+        (codecs.BOM_UTF32_BE, 'utf-32'),
+        (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16'),
+    )
+    header_pattern = re.compile(r'charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+    meta_pattern = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+    # 按HTML标准，这些声明实际按超集编码处理
+    aliases = {
+        'gb2312': 'gb18030',
+        'gbk': 'gb18030',
+        'x-gbk': 'gb18030',
+        'iso-8859-1': 'cp1252',
+        'latin1': 'cp1252',
+        'ascii': 'cp1252',
+        'us-ascii': 'cp1252',
+    }
+    tiers = ('bom', 'header', 'meta', 'host_cache', 'statistical', 'default')
+
+    def __init__(self, prescan_bytes=4096, sample_bytes=64 * 1024, cache_ttl=600):
+        self.prescan_bytes = prescan_bytes
+        self.sample_bytes = sample_bytes
+        self.cache_ttl = cache_ttl
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys(self.tiers, 0)
+
+    @classmethod
+    def shared(cls, config):
+        """按配置获取当前进程的编码检测器"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls(config['charset_prescan_bytes'], config['charset_sample_bytes'],
+                                      config['charset_cache_ttl'])
+        return cls._shared
+
+    def _normalize(self, label):
+        """把编码名称规范为Python编解码器名称，未知编码返回None"""
+        if isinstance(label, bytes):
+            label = label.decode('ascii', errors='ignore')
+        label = label.strip().lower()
+        label = self.aliases.get(label, label)
+        try:
+            return codecs.lookup(label).name
+        except LookupError:
+            return None
+
+    def detect(self, sample, content_type='', host=''):
+        """返回页面编码，sample为页面开头的字节"""
+        encoding, tier = self._detect(sample, content_type, host)
+        with self._lock:
+            self.counts[tier] += 1
+            if host and tier in ('header', 'meta', 'statistical'):
+                self._hosts[host] = (encoding, time.time() + self.cache_ttl)
+        return encoding
+
+    def _detect(self, sample, content_type, host):
+        for bom, encoding in self.boms:
+            if sample.startswith(bom):
+                return encoding, 'bom'
+
+        match = self.header_pattern.search(content_type)
+        if match:
+            encoding = self._normalize(match.group(1))
+            if encoding:
+                return encoding, 'header'
+
+        match = self.meta_pattern.search(sample, 0, self.prescan_bytes)
+        if match:
+            encoding = self._normalize(match.group(1))
+            if encoding:
+                # 能用ASCII写出meta声明的页面不可能是UTF-16/32
+                if encoding.startswith(('utf-16', 'utf-32')):
+                    encoding = 'utf-8'
+                return encoding, 'meta'
+
+        with self._lock:
+            cached = self._hosts.get(host)
+            if cached and cached[1] <= time.time():
+                del self._hosts[host]
+                cached = None
+        if cached:
+            return cached[0], 'host_cache'
+
+        detected = requests.compat.chardet.detect(sample[:self.sample_bytes])
+        if detected and detected.get('encoding'):
+            encoding = self._normalize(detected['encoding'])
+            if encoding:
+                # 开头全是ASCII时后面更可能是UTF-8
+                if encoding in ('ascii', 'cp1252') and sample[:self.sample_bytes].isascii():
+                    encoding = 'utf-8'
+                return encoding, 'statistical'
+        return 'utf-8', 'default'
+
+    def stats(self):
+        """各级检测的命中次数"""
+        with self._lock:
+            return {
+                'tiers': dict(self.counts),
+                'cached_hosts': len(self._hosts),
+                'cache_ttl': self.cache_ttl,
+            }
+
+
+class _UrlResolver:
+    """预先拆分好的基准URL
+
+    站内常见的根路径和简单相对路径直接拼接到基准URL上，结果与urljoin一致；
+    带协议、点号路径段或其他特殊写法的地址仍交给urljoin处理。
+    """
+
+    simple_url = re.compile(r"[A-Za-z0-9\-._~%!$&'()*+,=@/]+(?:\?[^#\s;]+)?")
+    dot_segment = re.compile(r'(?:^|/)\.{1,2}(?:/|$)')
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        parts = urllib.parse.urlsplit(base_url)
+        self.origin = None
+        self.directory = None
+        if parts.scheme and parts.netloc:
+            self.origin = f'{parts.scheme}://{parts.netloc}'
+            directory = parts.path[:parts.path.rfind('/') + 1] or '/'
+            if '//' not in directory and ';' not in directory and not self.dot_segment.search(directory):
+                self.directory = self.origin + directory
+
+    def resolve(self, url):
+        if self.origin and self.simple_url.fullmatch(url) and '//' not in url:
+            path = url.split('?', 1)[0]
+            if not self.dot_segment.search(path):
+                if url.startswith('/'):
+                    return self.origin + url
+                if self.directory:
+                    return self.directory + url
+        return urllib.parse.urljoin(self.base_url, url)
+
+
+class UrlRewriteCache:
+    """页面URL改写结果的缓存
+
+    以(基准URL, 原始地址)为键缓存解析和编码后的代理地址，搜索页和门户页中
+    重复出现的图标、统计像素和翻页链接只需计算一次；每个基准URL只拆分一次。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_entries=16384):
+        self.max_entries = max_entries
+        self._proxy_url = functools.lru_cache(maxsize=max_entries)(self._build_proxy_url)
+        self._resolver = functools.lru_cache(maxsize=256)(_UrlResolver)
+
+    @classmethod
+    def shared(cls, config):
+        """按配置获取当前进程的URL缓存"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls(config['url_cache_entries'])
+        return cls._shared
+
+    def _build_proxy_url(self, base_url, url):
+        return "/proxy?url=" + urllib.parse.quote(self._resolver(base_url).resolve(url))
+
+    def proxy_url(self, base_url, url):
+        """返回url相对于base_url解析后的代理地址"""
+        return self._proxy_url(base_url, url)
+
+    def stats(self):
+        """缓存命中统计"""
+        info = self._proxy_url.cache_info()
+        resolvers = self._resolver.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            'entries': info.currsize,
+            'max_entries': self.max_entries,
+            'hits': info.hits,
+            'misses': info.misses,
+            'hit_rate': round(info.hits / lookups, 3) if lookups else 0.0,
+            'base_urls': resolvers.currsize,
+        }
+
+
+class _StreamingHTMLRewriter(html.parser.HTMLParser):
+    """基于增量分词的HTML重写器
+
+    不建立文档树，标签经过时直接改写href/src/action/style属性和meta refresh，
+    在head开头补充字符集声明，在body开头插入导航栏、结尾注入拦截脚本。
+    未改动的标签和文本按原样输出，内存占用与页面大小无关。
+    """
+
+    resource_tags = {'img', 'script', 'link', 'iframe', 'source', 'embed', 'object'}
+    # 可以出现在正文之前的标签，遇到其他标签说明正文已经开始
+    head_tags = {'html', 'head', 'meta', 'title', 'link', 'style', 'script', 'base', 'noscript', 'template'}
+    def __init__(self, handler, base_url):
+        super().__init__(convert_charrefs=False)
+        self.handler = handler
+        self.base_url = base_url
+        self.bilibili = 'bilibili.com' in base_url
+        self.output = []
+        # 页面开头已提前发出时，不再补充字符集声明和导航栏
+        self.head_done = handler._prelude_sent
+        self.body_open = handler._prelude_sent
+        self.synthetic_body = False
+        self.script_done = False
+        # 正在缓冲内容的style/script标签
+        self.raw_tag = None
+        self.raw_start = ''
+        self.raw_data = []
+
+    def take_output(self):
+        """取出目前已完成改写的HTML"""
+        output = ''.join(self.output)
+        self.output = []
+        return output
+
+    def close(self):
+        super().close()
+        if self.raw_tag:
+            self._finish_raw()
+        self._open_head()
+        self._open_body()
+        self._inject_script()
+
+    def _open_head(self):
+        if not self.head_done:
+            self.head_done = True
+            self.output.append('<head><meta charset="utf-8"/></head>')
+
+    def _open_body(self):
+        if not self.body_open:
+            self.body_open = True
+            self.synthetic_body = True
+            self.output.append('<body style="margin-top: 50px;">')
+            self.output.append(self.handler._navigation_html(self.base_url))
+
+    def _inject_script(self):
+        if not self.script_done:
+            self.script_done = True
+            self.output.append(self.handler._interception_script_tag(self.base_url))
+            if self.synthetic_body:
+                self.output.append('</body>')
+
+    def _rewrite_attrs(self, tag, attrs):
+        """改写标签属性，没有改动时返回None"""
+        no_proxy = ('data-no-proxy', 'true') in attrs
+        refresh = tag == 'meta' and any(name == 'http-equiv' and (value or '').lower() == 'refresh'
+                                        for name, value in attrs)
+        stylesheet = tag == 'link' and any(name == 'rel' and 'stylesheet' in (value or '').lower()
+                                           for name, value in attrs)
+        result = []
+        changed = False
+        for name, original in attrs:
+            value = new_value = original
+            if value is None:
+                pass
+            elif name == 'style':
+                new_value = self.handler._rewrite_css_urls(value, self.base_url)
+            elif name == 'href' and tag in ('a', 'link') and not no_proxy:
+                if self.bilibili and stylesheet and value:
+                    value += '?t=' + str(int(time.time()))
+                new_value = self.handler._proxy_url(value, self.base_url)
+                if stylesheet:
+                    self.handler._collect_preload_hint(tag, new_value)
+            elif name == 'action' and tag == 'form':
+                new_value = self.handler._proxy_url(value, self.base_url)
+            elif name == 'src' and tag in self.resource_tags:
+                if self.bilibili and tag == 'script' and value and not value.startswith('http'):
+                    value = 'https:' + value if value.startswith('//') else 'https://www.bilibili.com' + value
+                new_value = self.handler._proxy_url(value, self.base_url)
+                if tag == 'script':
+                    self.handler._collect_preload_hint(tag, new_value)
+            elif name == 'content' and refresh:
+                new_value = self.handler._rewrite_meta_refresh(value, self.base_url)
+            if new_value != original:
+                changed = True
+            result.append((name, new_value))
+        return result if changed else None
+
+    def _format_tag(self, tag, attrs, self_closing=False):
+        parts = [tag]
+        for name, value in attrs:
+            parts.append(name if value is None else f'{name}="{html.escape(value)}"')
+        return '<' + ' '.join(parts) + (' />' if self_closing else '>')
+
+    def _start_tag_text(self, tag, attrs, self_closing=False):
+        if tag == 'body':
+            attrs = list(attrs)
+            for index, (name, value) in enumerate(attrs):
+                if name == 'style':
+                    if 'margin-top' not in (value or ''):
+                        attrs[index] = (name, value + '; margin-top: 50px;' if value else 'margin-top: 50px;')
+                    break
+            else:
+                attrs.append(('style', 'margin-top: 50px;'))
+        else:
+            rewritten = self._rewrite_attrs(tag, attrs)
+            if rewritten is None:
+                return self.get_starttag_text()
+            attrs = rewritten
+        return self._format_tag(tag, attrs, self_closing)
+
+    def _before_tag(self, tag):
+        if not self.head_done and tag not in ('html', 'head'):
+            self._open_head()
+        if not self.body_open and tag != 'body' and tag not in self.head_tags:
+            self._open_body()
+
+    def handle_starttag(self, tag, attrs):
+        self._emit_tag(tag, attrs, False)
+
+    def handle_startendtag(self, tag, attrs):
+        self._emit_tag(tag, attrs, True)
+
+    def _emit_tag(self, tag, attrs, self_closing):
+        self._before_tag(tag)
+        if tag == 'meta' and self.handler._is_charset_meta(dict(attrs)):
+            return
+        text = self._start_tag_text(tag, attrs, self_closing)
+        if tag == 'head' and not self.head_done:
+            self.head_done = True
+            self.output.append(text + '<meta charset="utf-8"/>')
+        elif tag == 'body' and not self.body_open:
+            self.body_open = True
+            self.output.append(text + self.handler._navigation_html(self.base_url))
+        elif tag == 'body':
+            self.output.append(text)
+        elif not self_closing and (tag == 'style' or (tag == 'script' and self.bilibili)):
+            # 样式表需要整体改写url()，哔哩哔哩页面的脚本需要整体检查后决定是否移除
+            self.raw_tag = tag
+            self.raw_start = text
+            self.raw_data = []
+        else:
+            self.output.append(text)
+
+    def _finish_raw(self):
+        content = ''.join(self.raw_data)
+        tag = self.raw_tag
+        self.raw_tag = None
+        if tag == 'style':
+            content = self.handler._rewrite_css_urls(content, self.base_url)
+        elif '412' in content or 'precondition' in content.lower():
+            return
+        self.output.append(self.raw_start + content + f'</{tag}>')
+
+    def handle_endtag(self, tag):
+        if self.raw_tag == tag:
+            self._finish_raw()
+            return
+        if tag == 'body' or (tag == 'html' and not self.script_done):
+            self._open_head()
+            self._open_body()
+            self._inject_script()
+        self.output.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if self.raw_tag:
+            self.raw_data.append(data)
+        else:
+            self.output.append(data)
+
+    def handle_entityref(self, name):
+        self.output.append(f'&{name};')
+
+    def handle_charref(self, name):
+        self.output.append(f'&#{name};')
+
+    def handle_comment(self, data):
+        self.output.append(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self.output.append(f'<!{decl}>')
+
+    def handle_pi(self, data):
+        self.output.append(f'<?{data}>')
+
+    def unknown_decl(self, data):
+        self.output.append(f'<![{data}]>')
+
+
+class _NoCookiePolicy(http.cookiejar.DefaultCookiePolicy):
+    """共享会话不保存Cookie，避免不同用户之间串号"""
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+class _PoolStatsMixin:
+    """记录连接复用命中情况，并丢弃空闲过久的连接"""
+
+    client = None
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        if conn.sock is not None:
+            idle_since = getattr(conn, 'idle_since', None)
+            if idle_since is not None and time.monotonic() - idle_since > self.client.idle_timeout:
+                conn.close()
+                self.client.record(self.host, 'expired')
+        self.client.record(self.host, 'hits' if conn.sock is not None else 'misses')
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.idle_since = time.monotonic()
+        super()._put_conn(conn)
+
+
+class _PooledAdapter(HTTPAdapter):
+    """使用统计连接池的适配器"""
+
+    def __init__(self, client, **kwargs):
+        self.client = client
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('StatsHTTPConnectionPool', (_PoolStatsMixin, HTTPConnectionPool),
+                         {'client': self.client}),
+            'https': type('StatsHTTPSConnectionPool', (_PoolStatsMixin, HTTPSConnectionPool),
+                          {'client': self.client}),
+        }
+
+
+class UpstreamClient:
+    """共享的上游HTTP客户端
+
+    所有上游请求共用一个会话，按主机保持keep-alive连接池，
+    避免每个请求都重新进行TCP和TLS握手。连接池本身是线程安全的，
+    会话不保存Cookie，因此可以被所有工作线程同时使用。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, pool_connections=64, pool_maxsize=16, idle_timeout=30):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self.session = requests.Session()
+        self.session.cookies.set_policy(_NoCookiePolicy())
+        adapter = _PooledAdapter(self, pool_connections=pool_connections,
+                                 pool_maxsize=pool_maxsize, pool_block=False)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def shared(cls, config):
+        """按配置获取当前进程共享的客户端"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls(config['pool_connections'], config['pool_maxsize'],
+                                      config['pool_idle_timeout'])
+        return cls._shared
+
+    def record(self, host, event):
+        """记录连接池事件"""
+        with self._lock:
+            counters = self._hosts.get(host)
+            if counters is None:
+                counters = self._hosts[host] = {'hits': 0, 'misses': 0, 'expired': 0}
+            counters[event] += 1
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def stats(self):
+        """连接池命中统计"""
+        with self._lock:
+            hosts = {host: dict(counters) for host, counters in self._hosts.items()}
+        hits = sum(c['hits'] for c in hosts.values())
+        misses = sum(c['misses'] for c in hosts.values())
+        return {
+            'pool_connections': self.pool_connections,
+            'pool_maxsize': self.pool_maxsize,
+            'idle_timeout': self.idle_timeout,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0.0,
+            'hosts': hosts,
+        }
+
+
+class _SharedResponse:
+    """合并的请求之间共享的上游结果
+
+    html为重写后的页面，entry为整体读入的小资源；两者都为None时表示上游返回了错误状态，
+    status_code和headers供生成错误页面或重定向页面使用。
+    """
+
+    def __init__(self, status_code, headers, html=None, entry=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.html = html
+        self.entry = entry
+
+
+class _Flight:
+    """一次正在进行的上游访问"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class RequestCoalescer:
+    """合并同时到达的相同上游请求(single-flight)
+
+    第一个请求成为领头请求并实际访问上游，访问期间到达的相同请求等待它完成，
+    直接使用它的结果或重新抛出它的异常。领头请求完成时先从表中移除，
+    之后到达的请求会重新访问上游，不会拿到过期的结果。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, wait_timeout=60):
+        self.wait_timeout = wait_timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.shared_errors = 0
+        self.unshareable = 0
+        self.wait_timeouts = 0
+        self.max_waiters = 0
+
+    @classmethod
+    def shared(cls, config):
+        """按配置获取当前进程共享的合并器"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls(config['coalesce_wait_timeout'])
+        return cls._shared
+
+    def run(self, key, fetch, timeout=None):
+        """执行或等待key对应的上游访问
+
+        fetch()返回(可共享的结果, 仅领头请求使用的值)。领头请求得到fetch的返回值；
+        跟随的请求得到(共享结果, None)，结果不可共享或等待超时时得到(None, None)。
+        timeout为跟随的请求剩余的时间预算，与wait_timeout取较小值。
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                flight.waiters += 1
+                self.followers += 1
+                self.max_waiters = max(self.max_waiters, flight.waiters)
+
+        if not leader:
+            wait_timeout = self.wait_timeout if timeout is None else min(timeout, self.wait_timeout)
+            if not flight.done.wait(wait_timeout):
+                with self._lock:
+                    self.wait_timeouts += 1
+                return None, None
+            if flight.error is not None:
+                with self._lock:
+                    self.shared_errors += 1
+                raise flight.error
+            if flight.result is None:
+                with self._lock:
+                    self.unshareable += 1
+            return flight.result, None
+
+        try:
+            result = fetch()
+            flight.result = result[0]
+            return result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        """合并统计，coalesce_ratio为直接使用领头请求结果的请求比例"""
+        with self._lock:
+            total = self.leaders + self.followers
+            coalesced = self.followers - self.unshareable - self.wait_timeouts - self.shared_errors
+            return {
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'followers': self.followers,
+                'coalesce_ratio': round(coalesced / total, 3) if total else 0.0,
+                'shared_errors': self.shared_errors,
+                'unshareable': self.unshareable,
+                'wait_timeouts': self.wait_timeouts,
+                'max_waiters': self.max_waiters,
+            }
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """客户端请求的总时间预算已经用完"""
+
+    def __init__(self, stage):
+        # 异常信息会出现在错误响应的状态行中，只能使用ASCII字符
+        super().__init__(f"Request deadline exceeded ({stage})")
+        self.stage = stage
+
+
+class Deadline:
+    """一次客户端请求的总时间预算
+
+    连接和读取超时只限制单次socket操作，缓慢滴送数据的上游可以一直占住工作线程。
+    请求开始时创建Deadline，之后的上游访问、读取页面、进程池重写和等待合并的请求
+    都从同一份剩余时间中扣除，嵌套的访问用child()继承剩余预算。
+    超出预算的次数按阶段计数：connect、headers、redirect、body、rewrite、coalesce_wait。
+    """
+
+    _lock = threading.Lock()
+    exceeded = {}
+
+    def __init__(self, budget=None, expires_at=None):
+        if expires_at is None and budget:
+            expires_at = time.monotonic() + budget
+        self.expires_at = expires_at
+
+    def child(self, budget):
+        """不超过当前剩余预算的子预算"""
+        expires_at = time.monotonic() + budget if budget else None
+        if self.expires_at is not None and (expires_at is None or self.expires_at < expires_at):
+            expires_at = self.expires_at
+        return Deadline(expires_at=expires_at)
+
+    def remaining(self):
+        """剩余秒数，不限制时返回None"""
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def timeout(self, connect_timeout, read_timeout):
+        """按剩余预算收紧的(连接超时, 读取超时)，预算已经用完时抛出DeadlineExceeded"""
+        remaining = self.remaining()
+        if remaining is None:
+            return connect_timeout, read_timeout
+        if remaining <= 0:
+            raise self.exceed('connect')
+        return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+    def check(self, stage):
+        """预算已经用完时抛出DeadlineExceeded"""
+        if self.expired():
+            raise self.exceed(stage)
+
+    def watch(self, response):
+        """读取上游响应期间监视预算，用完时关闭连接打断阻塞的读取；读完后调用cancel()"""
+        if self.expires_at is None:
+            return _DeadlineWatch(None)
+        return DeadlineWatchdog.shared().watch(self.expires_at, response)
+
+    @classmethod
+    def exceed(cls, stage):
+        """记录一次超出预算，返回对应的异常"""
+        with cls._lock:
+            cls.exceeded[stage] = cls.exceeded.get(stage, 0) + 1
+        return DeadlineExceeded(stage)
+
+    @classmethod
+    def stats(cls):
+        """各阶段超出预算的次数"""
+        watchdog = DeadlineWatchdog._shared
+        with cls._lock:
+            return {'exceeded': dict(cls.exceeded), 'total_exceeded': sum(cls.exceeded.values()),
+                    'interrupted_reads': watchdog.interrupted if watchdog else 0}
+
+
+class _DeadlineWatch:
+    """一次读取的监视记录，fired表示已经因预算用完关闭了连接"""
+
+    def __init__(self, response):
+        self.response = response
+        self.cancelled = response is None
+        self.fired = False
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        # 持锁设置，保证连接归还连接池之后不会再被关闭
+        with self._lock:
+            self.cancelled = True
+
+    def interrupt(self):
+        """关闭上游socket，阻塞在读取上的线程随即出错返回"""
+        with self._lock:
+            if self.cancelled:
+                return False
+            self.fired = True
+            raw = self.response.raw
+            sock = getattr(getattr(raw, '_connection', None), 'sock', None)
+            if sock is None:
+                # 连接已经交还时从http.client的响应对象取socket
+                sock = getattr(getattr(getattr(getattr(raw, '_fp', None), 'fp', None), 'raw', None), '_sock', None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            return True
+
+
+class DeadlineWatchdog:
+    """在请求预算用完时打断阻塞中的上游读取
+
+    读取超时只限制单次socket操作，持续滴送少量数据的上游可以让一次读取一直阻塞，
+    在读取之间检查预算来不及。所有请求共用一个后台线程，按到期时间排队，
+    到期时关闭对应的上游连接。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self.interrupted = 0
+        threading.Thread(target=self._run, name='deadline-watchdog', daemon=True).start()
+
+    @classmethod
+    def shared(cls):
+        """获取当前进程的看门狗线程"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls()
+        return cls._shared
+
+    def watch(self, expires_at, response):
+        """在expires_at(time.monotonic)时打断response的读取"""
+        watch = _DeadlineWatch(response)
+        with self._cond:
+            heapq.heappush(self._heap, (expires_at, next(self._counter), watch))
+            self._cond.notify()
+        return watch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    # 已取消的记录在到达队首时丢弃
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        watch = heapq.heappop(self._heap)[2]
+                        break
+                    self._cond.wait(delay)
+            if watch.interrupt():
+                self.interrupted += 1
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """上游主机已熔断，请求没有发出"""
+
+
+class _HostCircuit:
+    """单个上游主机的熔断状态"""
+
+    def __init__(self, window):
+        self.state = 'closed'
+        self.outcomes = deque(maxlen=window)  # 最近请求的(是否失败, 是否过慢)
+        self.opened_at = 0.0
+        self.probes = 0
+        self.requests = 0
+        self.failures = 0
+        self.opens = 0
+        self.rejected = 0
+
+
+class CircuitBreaker:
+    """按上游主机熔断
+
+    closed: 正常放行，统计最近的请求，失败或过慢的比例达到阈值时打开。
+    open: 直接拒绝请求，经过open_seconds后转为half_open。
+    half_open: 只放行少量探测请求，探测成功则关闭并清空统计，失败或过慢则重新打开。
+    跟踪的主机数有上限，超出时优先淘汰最久未访问的closed状态主机。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, window=20, min_requests=10, error_rate=0.5, slow_seconds=10, slow_rate=0.8,
+                 open_seconds=30, probes=1, error_statuses=(412, 429), max_hosts=1024):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.error_statuses = set(error_statuses)
+        self.max_hosts = max_hosts
+        self._circuits = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, config):
+        """按配置获取当前进程共享的熔断器"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls(config['breaker_window'], config['breaker_min_requests'],
+                                      config['breaker_error_rate'], config['breaker_slow_seconds'],
+                                      config['breaker_slow_rate'], config['breaker_open_seconds'],
+                                      config['breaker_probes'], config['breaker_error_statuses'],
+                                      config['breaker_max_hosts'])
+        return cls._shared
+
+    def _circuit(self, host):
+        circuit = self._circuits.get(host)
+        if circuit is None:
+            circuit = self._circuits[host] = _HostCircuit(self.window)
+            if len(self._circuits) > self.max_hosts:
+                self._evict()
+        else:
+            self._circuits.move_to_end(host)
+        return circuit
+
+    def _evict(self):
+        # 熔断中的主机被淘汰会提前恢复放行，只在全部处于熔断时才淘汰它们
+        for host, circuit in self._circuits.items():
+            if circuit.state == 'closed':
+                del self._circuits[host]
+                return
+        self._circuits.popitem(last=False)
+
+    def is_failure_status(self, status_code):
+        """状态码是否说明主机本身出了问题(404等只与单个资源有关)"""
+        return status_code >= 500 or status_code in self.error_statuses
+
+    def allow(self, host):
+        """判断是否放行发往host的请求，返回(是否放行, 是否为探测请求)"""
+        with self._lock:
+            circuit = self._circuit(host)
+            if circuit.state == 'open':
+                if time.time() - circuit.opened_at < self.open_seconds:
+                    circuit.rejected += 1
+                    return False, False
+                circuit.state = 'half_open'
+                circuit.probes = 0
+            if circuit.state == 'half_open':
+                if circuit.probes >= self.probes:
+                    circuit.rejected += 1
+                    return False, False
+                circuit.probes += 1
+                return True, True
+            return True, False
+
+    def record(self, host, failed, elapsed, probe=False):
+        """记录一次请求的结果"""
+        slow = elapsed >= self.slow_seconds
+        with self._lock:
+            circuit = self._circuit(host)
+            circuit.requests += 1
+            if failed:
+                circuit.failures += 1
+            if probe:
+                circuit.probes = max(circuit.probes - 1, 0)
+                if failed or slow:
+                    self._open(circuit, host)
+                elif circuit.state == 'half_open':
+                    circuit.state = 'closed'
+                    circuit.outcomes.clear()
+                    print(f"熔断恢复: {host}")
+                return
+            # 熔断前已经发出的请求陆续返回，不再影响状态
+            if circuit.state != 'closed':
+                return
+            circuit.outcomes.append((failed, slow))
+            count = len(circuit.outcomes)
+            if count >= self.min_requests:
+                errors = sum(1 for f, _ in circuit.outcomes if f)
+                slows = sum(1 for _, s in circuit.outcomes if s)
+                if errors / count >= self.error_rate or slows / count >= self.slow_rate:
+                    self._open(circuit, host)
+
+    def release(self, host, probe=False):
+        """请求没有得到结果就中止，不计入统计，只归还探测名额"""
+        if not probe:
+            return
+        with self._lock:
+            circuit = self._circuit(host)
+            circuit.probes = max(circuit.probes - 1, 0)
+
+    def _open(self, circuit, host):
+        circuit.state = 'open'
+        circuit.opened_at = time.time()
+        circuit.opens += 1
+        circuit.outcomes.clear()
+        print(f"熔断打开: {host}，{self.open_seconds}秒后探测")
+
+    def stats(self):
+        """各主机的熔断状态，只列出出现过失败或熔断的主机"""
+        now = time.time()
+        with self._lock:
+            hosts = {}
+            for host, circuit in self._circuits.items():
+                if not (circuit.failures or circuit.opens):
+                    continue
+                count = len(circuit.outcomes)
+                hosts[host] = {
+                    'state': circuit.state,
+                    'requests': circuit.requests,
+                    'failures': circuit.failures,
+                    'window_error_rate': round(sum(1 for f, _ in circuit.outcomes if f) / count, 3) if count else 0.0,
+                    'window_slow_rate': round(sum(1 for _, s in circuit.outcomes if s) / count, 3) if count else 0.0,
+                    'opens': circuit.opens,
+                    'rejected': circuit.rejected,
+                    'retry_in': max(round(circuit.opened_at + self.open_seconds - now, 1), 0)
+                                if circuit.state == 'open' else 0,
+                }
+            return {
+                'open': sum(1 for c in self._circuits.values() if c.state != 'closed'),
+                'tracked_hosts': len(self._circuits),
+                'hosts': hosts,
+            }
+
+
+class _NegativeEntry:
+    """一次访问失败的记录"""
+
+    def __init__(self, failure, status_code, message, ttl):
+        self.failure = failure
+        self.status_code = status_code
+        self.message = message
+        self.expires_at = time.time() + ttl
+
+
+class NegativeCache:
+    """按资源URL记录近期访问失败的结果
+
+    失效的跟踪脚本或不存在的图片在每次打开页面时都会被重新请求，网络错误时还要等到超时。
+    记录失败后在按失败类型设定的时间内直接返回失败，不再占用工作线程。
+    条目数和按主机统计的主机数都有上限，超出时淘汰最久未使用的记录。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    dns_error_messages = ('Name or service not known', 'nodename nor servname', 'getaddrinfo failed',
+                          'Temporary failure in name resolution', 'No address associated')
+
+    def __init__(self, max_entries=4096, ttls=None, max_hosts=1024):
+        self.max_entries = max_entries
+        self.max_hosts = max_hosts
+        self.ttls = ttls or {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hosts = OrderedDict()
+        self.hits = 0
+        self.stores = 0
+        self.evictions = 0
+        self.failures = {}
+
+    @classmethod
+    def shared(cls, config):
+        """按配置获取当前进程共享的失败记录"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls(config['negative_cache_entries'], config['negative_cache_ttl'],
+                                      config['negative_cache_hosts'])
+        return cls._shared
+
+    @classmethod
+    def classify_error(cls, error):
+        """网络错误的失败类型"""
+        if isinstance(error, requests.exceptions.Timeout):
+            return 'timeout'
+        if isinstance(error, requests.exceptions.ConnectionError):
+            reason = error.args[0] if error.args else None
+            reason = getattr(reason, 'reason', reason)
+            name_error = getattr(urllib3.exceptions, 'NameResolutionError', None)
+            if (name_error and isinstance(reason, name_error)) or \
+                    any(message in str(reason) for message in cls.dns_error_messages):
+                return 'dns'
+            return 'connect'
+        return 'error'
+
+    @staticmethod
+    def classify_status(status_code):
+        """上游状态码的失败类型，不算失败时返回None"""
+        if status_code in (404, 410):
+            return 'not_found'
+        if status_code >= 500:
+            return 'server_error'
+        if status_code >= 400:
+            return 'client_error'
+        return None
+
+    def _host_counters(self, url):
+        host = urllib.parse.urlsplit(url).hostname or ''
+        counters = self._hosts.get(host)
+        if counters is None:
+            counters = self._hosts[host] = {'failures': 0, 'blocked': 0}
+            while len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        else:
+            self._hosts.move_to_end(host)
+        return counters
+
+    def record_error(self, url, error):
+        """记录网络错误"""
+        self._store(url, self.classify_error(error), None, str(error))
+
+    def record_status(self, url, status_code):
+        """记录上游错误状态码"""
+        failure = self.classify_status(status_code)
+        if failure:
+            self._store(url, failure, status_code, f'HTTP {status_code}')
+
+    def _store(self, url, failure, status_code, message):
+        ttl = self.ttls.get(failure, 0)
+        with self._lock:
+            self._host_counters(url)['failures'] += 1
+            self.failures[failure] = self.failures.get(failure, 0) + 1
+            if ttl <= 0 or self.max_entries <= 0:
+                return
+            self._entries.pop(url, None)
+            self._entries[url] = _NegativeEntry(failure, status_code, message, ttl)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def lookup(self, url):
+        """返回仍在有效期内的失败记录"""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                del self._entries[url]
+                return None
+            self._entries.move_to_end(url)
+            self.hits += 1
+            self._host_counters(url)['blocked'] += 1
+            return entry
+
+    def stats(self):
+        """失败记录统计，hosts中failures为访问失败次数，blocked为直接返回失败的次数"""
+        with self._lock:
+            return {
+                'max_entries': self.max_entries,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'failures': dict(self.failures),
+                'ttls': dict(self.ttls),
+                'hosts': {host: dict(counters) for host, counters in self._hosts.items()},
+            }
+
+
+class _CacheEntry:
+    """缓存的上游响应"""
+
+    def __init__(self, headers, body, content_encoding, vary, vary_header, lifetime):
+        self.headers = headers
+        self.body = body
+        self.content_encoding = content_encoding
+        self.vary = vary
+        self.vary_header = vary_header
+        self.stored_at = time.time()
+        self.expires_at = self.stored_at + lifetime
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers)
+        header_map = {k.lower(): v for k, v in headers}
+        self.etag = header_map.get('etag')
+        self.last_modified = header_map.get('last-modified')
+
+    def age(self):
+        return int(time.time() - self.stored_at)
+
+    @staticmethod
+    def decodable_encodings():
+        """可以在命中时解压的压缩格式"""
+        encodings = {'gzip', 'x-gzip', 'deflate'}
+        if brotli is not None:
+            encodings.add('br')
+        return encodings
+
+    def decoded_body(self):
+        """返回解压后的内容"""
+        if self.content_encoding == 'br':
+            return brotli.decompress(self.body)
+        if self.content_encoding == 'deflate':
+            try:
+                return zlib.decompress(self.body)
+            except zlib.error:
+                return zlib.decompress(self.body, -zlib.MAX_WBITS)
+        return zlib.decompress(self.body, 16 + zlib.MAX_WBITS)
+
+
+class ResponseCache:
+    """进程内的静态资源缓存
+
+    按总字节数限制大小，超出时淘汰最久未使用的条目。遵守上游的
+    Cache-Control(no-store/private/no-cache/max-age/s-maxage)、Expires和Vary，
+    没有明确有效期的响应不缓存。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    # 转发时会替换或重新计算的响应头
+    skipped_headers = {'content-encoding', 'transfer-encoding', 'content-length', 'connection',
+                       'vary', 'age', 'keep-alive', 'set-cookie', 'date', 'server', 'accept-ranges'}
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_bytes=2 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expired = 0
+        self.revalidated = 0
+
+    @classmethod
+    def shared(cls, config):
+        """按配置获取当前进程共享的缓存"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls(config['memory_cache_bytes'], config['memory_cache_max_entry'])
+        return cls._shared
+
+    @staticmethod
+    def parse_cache_control(value):
+        """解析Cache-Control为{指令: 参数}"""
+        directives = {}
+        for part in (value or '').split(','):
+            name, _, argument = part.strip().partition('=')
+            if name:
+                directives[name.lower()] = argument.strip().strip('"')
+        return directives
+
+    @classmethod
+    def freshness_lifetime(cls, headers):
+        """计算响应的剩余有效秒数，不可缓存时返回None"""
+        directives = cls.parse_cache_control(headers.get('Cache-Control'))
+        if 'no-store' in directives or 'private' in directives or 'no-cache' in directives:
+            return None
+        lifetime = None
+        for name in ('s-maxage', 'max-age'):
+            if name in directives:
+                try:
+                    lifetime = int(directives[name])
+                except ValueError:
+                    return None
+                break
+        if lifetime is None and headers.get('Expires'):
+            try:
+                expires = email.utils.parsedate_to_datetime(headers['Expires']).timestamp()
+                date = headers.get('Date')
+                now = email.utils.parsedate_to_datetime(date).timestamp() if date else time.time()
+            except (TypeError, ValueError, IndexError):
+                return None
+            lifetime = int(expires - now)
+        if lifetime is None:
+            return None
+        try:
+            lifetime -= int(headers.get('Age', 0))
+        except ValueError:
+            pass
+        return lifetime if lifetime > 0 else None
+
+    def is_cacheable(self, response):
+        """判断上游响应是否可以放入共享缓存"""
+        if response.request.method != 'GET' or response.status_code != 200:
+            return False
+        headers = response.headers
+        if 'Set-Cookie' in headers or headers.get('Vary', '').strip() == '*':
+            return False
+        if 'Range' in response.request.headers:
+            return False
+        length = headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > self.max_entry_bytes:
+            return False
+        return self.freshness_lifetime(headers) is not None
+
+    @staticmethod
+    def _vary_names(vary_header):
+        # 客户端的压缩协商由代理自己处理(条目可以解压)，不参与变体匹配
+        return [name.strip().lower() for name in vary_header.split(',')
+                if name.strip() and name.strip().lower() != 'accept-encoding']
+
+    @classmethod
+    def make_entry(cls, response, body, content_encoding, lifetime=0):
+        """由上游响应和读取的内容构造缓存条目"""
+        vary_header = response.headers.get('Vary', '')
+        request_headers = response.request.headers
+        vary = {name: request_headers.get(name) for name in cls._vary_names(vary_header)}
+        headers = [(k, v) for k, v in response.headers.items() if k.lower() not in cls.skipped_headers]
+        return _CacheEntry(headers, body, content_encoding, vary, vary_header, lifetime)
+
+    def store(self, key, response, body, content_encoding):
+        """保存响应，content_encoding为body的压缩格式(已解压则为None)"""
+        lifetime = self.freshness_lifetime(response.headers)
+        if lifetime is None or len(body) > self.max_entry_bytes:
+            return
+        if content_encoding and content_encoding not in _CacheEntry.decodable_encodings():
+            return
+        entry = self.make_entry(response, body, content_encoding, lifetime)
+
+        with self._lock:
+            variants = self._entries.pop(key, [])
+            for old in variants:
+                if old.vary == entry.vary:
+                    variants.remove(old)
+                    self.size -= old.size
+                    break
+            variants.append(entry)
+            self._entries[key] = variants
+            self.size += entry.size
+            self.stores += 1
+            while self.size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                for old in evicted:
+                    self.size -= old.size
+                    self.evictions += 1
+
+    def lookup(self, key, request_headers):
+        """查找与请求头匹配且未过期的缓存条目"""
+        request_headers = CaseInsensitiveDict(request_headers)
+        now = time.time()
+        with self._lock:
+            variants = self._entries.get(key)
+            if variants:
+                for entry in list(variants):
+                    if entry.expires_at <= now:
+                        # 带验证器的过期条目保留下来，供向上游条件请求重新验证
+                        if not (entry.etag or entry.last_modified):
+                            variants.remove(entry)
+                            self.size -= entry.size
+                            self.expired += 1
+                        continue
+                    if all(request_headers.get(name) == value for name, value in entry.vary.items()):
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        return entry
+                if not variants:
+                    del self._entries[key]
+            self.misses += 1
+            return None
+
+    def lookup_stale(self, key, request_headers):
+        """查找与请求头匹配、已过期但带验证器的条目"""
+        request_headers = CaseInsensitiveDict(request_headers)
+        now = time.time()
+        with self._lock:
+            for entry in self._entries.get(key, ()):
+                if entry.expires_at <= now and all(request_headers.get(name) == value
+                                                   for name, value in entry.vary.items()):
+                    return entry
+        return None
+
+    def refresh(self, entry, headers):
+        """上游返回304后更新有效期和验证器"""
+        lifetime = self.freshness_lifetime(headers) or 0
+        with self._lock:
+            entry.stored_at = time.time()
+            entry.expires_at = entry.stored_at + lifetime
+            entry.etag = headers.get('ETag', entry.etag)
+            entry.last_modified = headers.get('Last-Modified', entry.last_modified)
+            self.revalidated += 1
+
+    def stats(self):
+        """缓存统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'max_bytes': self.max_bytes,
+                'size': self.size,
+                'entries': sum(len(v) for v in self._entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'expired': self.expired,
+                'revalidated': self.revalidated,
+            }
+
+
+class _DiskEntry:
+    """磁盘缓存的元数据"""
+
+    def __init__(self, meta, meta_path, blob_path):
+        self.url = meta['url']
+        self.digest = meta['digest']
+        self.size = meta['size']
+        self.headers = [tuple(item) for item in meta['headers']]
+        self.etag = meta.get('etag')
+        self.last_modified = meta.get('last_modified')
+        self.expires_at = meta.get('expires_at', 0)
+        self.meta_path = meta_path
+        self.blob_path = blob_path
+
+    def is_fresh(self):
+        return self.expires_at > time.time()
+
+    def to_meta(self):
+        return {
+            'url': self.url,
+            'digest': self.digest,
+            'size': self.size,
+            'headers': self.headers,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'expires_at': self.expires_at,
+        }
+
+
+class _DiskCacheWriter:
+    """边转发边写入临时文件，完成后按SHA-256摘要落盘"""
+
+    def __init__(self, cache, url, response):
+        self.cache = cache
+        self.url = url
+        self.response = response
+        self.hash = hashlib.sha256()
+        self.size = 0
+        fd, self.temp_path = tempfile.mkstemp(dir=cache.temp_dir)
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.file.close()
+        if self.size < self.cache.min_size:
+            os.unlink(self.temp_path)
+            return
+        self.cache.commit(self.url, self.response, self.temp_path, self.hash.hexdigest(), self.size)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+
+class DiskCache:
+    """大文件下载的磁盘缓存
+
+    内容按SHA-256摘要存放在blobs目录，相同内容只保存一份；meta目录按URL的哈希
+    保存JSON元数据，记录上游验证器(ETag/Last-Modified)、响应头和内容摘要。
+    缓存文件可以被多个工作进程共享，总大小超过上限时按最近使用时间淘汰。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, directory, max_bytes, min_size):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.blob_dir = os.path.join(directory, 'blobs')
+        self.meta_dir = os.path.join(directory, 'meta')
+        self.temp_dir = os.path.join(directory, 'tmp')
+        self.enabled = max_bytes > 0
+        if self.enabled:
+            try:
+                for path in (self.blob_dir, self.meta_dir, self.temp_dir):
+                    os.makedirs(path, exist_ok=True)
+            except OSError as e:
+                print(f"磁盘缓存不可用: {e}")
+                self.enabled = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_served = 0
+
+    @classmethod
+    def shared(cls, config):
+        """按配置获取当前进程的磁盘缓存"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls(config['disk_cache_dir'], config['disk_cache_bytes'],
+                                      config['disk_cache_min_size'])
+        return cls._shared
+
+    def _meta_path(self, url):
+        return os.path.join(self.meta_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def lookup(self, url):
+        """按URL查找缓存条目，内容文件已被淘汰时视为未命中"""
+        if not self.enabled:
+            return None
+        meta_path = self._meta_path(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            self._count('misses')
+            return None
+        blob_path = os.path.join(self.blob_dir, meta['digest'])
+        if meta.get('url') != url or not os.path.exists(blob_path):
+            if meta.get('url') == url:
+                try:
+                    os.unlink(meta_path)
+                except OSError:
+                    pass
+            self._count('misses')
+            return None
+        try:
+            # 以修改时间记录最近使用，供淘汰时排序
+            os.utime(blob_path)
+        except OSError:
+            pass
+        self._count('hits')
+        return _DiskEntry(meta, meta_path, blob_path)
+
+    def open_writer(self, url, response):
+        """响应适合写入磁盘缓存时返回写入器"""
+        if not self.enabled or response.request.method != 'GET' or response.status_code != 200:
+            return None
+        headers = response.headers
+        if 'Range' in response.request.headers or 'Set-Cookie' in headers:
+            return None
+        directives = ResponseCache.parse_cache_control(headers.get('Cache-Control'))
+        if 'no-store' in directives or 'private' in directives:
+            return None
+        # 磁盘缓存每个URL只保存一份，按其他请求头区分变体的响应不保存
+        if ResponseCache._vary_names(headers.get('Vary', '')):
+            return None
+        if not (headers.get('ETag') or headers.get('Last-Modified')
+                or ResponseCache.freshness_lifetime(headers)):
+            return None
+        length = headers.get('Content-Length')
+        if not length or not length.isdigit() or int(length) < self.min_size:
+            return None
+        if int(length) > self.max_bytes // 4:
+            return None
+        try:
+            return _DiskCacheWriter(self, url, response)
+        except OSError as e:
+            print(f"磁盘缓存写入失败: {e}")
+            return None
+
+    def _write_meta(self, entry):
+        fd, temp_path = tempfile.mkstemp(dir=self.temp_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry.to_meta(), f)
+        os.replace(temp_path, entry.meta_path)
+
+    def commit(self, url, response, temp_path, digest, size):
+        """保存内容和元数据"""
+        blob_path = os.path.join(self.blob_dir, digest)
+        os.replace(temp_path, blob_path)
+        lifetime = ResponseCache.freshness_lifetime(response.headers) or 0
+        headers = [(k, v) for k, v in response.headers.items()
+                   if k.lower() not in ResponseCache.skipped_headers]
+        meta = {
+            'url': url,
+            'digest': digest,
+            'size': size,
+            'headers': headers,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'expires_at': time.time() + lifetime,
+        }
+        try:
+            self._write_meta(_DiskEntry(meta, self._meta_path(url), blob_path))
+        except OSError as e:
+            print(f"磁盘缓存元数据写入失败: {e}")
+            return
+        self._count('stores')
+        self._evict()
+
+    def refresh(self, entry, headers):
+        """上游返回304后更新有效期和验证器"""
+        lifetime = ResponseCache.freshness_lifetime(headers) or 0
+        entry.expires_at = time.time() + lifetime
+        entry.etag = headers.get('ETag', entry.etag)
+        entry.last_modified = headers.get('Last-Modified', entry.last_modified)
+        try:
+            self._write_meta(entry)
+        except OSError:
+            pass
+        self._count('revalidated')
+
+    def record_served(self, count):
+        self._count('bytes_served', count)
+
+    def _evict(self):
+        """总大小超过上限时删除最久未使用的内容文件"""
+        try:
+            blobs = [entry for entry in os.scandir(self.blob_dir) if entry.is_file()]
+        except OSError:
+            return
+        stats = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in blobs]
+        total = sum(size for _, size, _ in stats)
+        evicted = False
+        for _, size, path in sorted(stats):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            evicted = True
+            self._count('evictions')
+        if evicted:
+            self._prune_meta()
+
+    def _prune_meta(self):
+        """删除内容文件已被淘汰的元数据文件"""
+        try:
+            metas = [entry.path for entry in os.scandir(self.meta_dir) if entry.name.endswith('.json')]
+        except OSError:
+            return
+        for meta_path in metas:
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    digest = json.load(f)['digest']
+                if os.path.exists(os.path.join(self.blob_dir, digest)):
+                    continue
+                os.unlink(meta_path)
+            except (OSError, ValueError, KeyError):
+                continue
+
+    def stats(self):
+        """磁盘缓存统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'directory': self.directory,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'revalidated': self.revalidated,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'bytes_served': self.bytes_served,
+            }
+
+
+class PreloadHistory:
+    """按页面URL记录上次访问时引用的样式表和脚本
+
+    提前发送页面开头时据此输出预加载提示，让浏览器在页面还在下载和重写时就开始
+    加载这些资源。记录的页面数有上限，按最近使用淘汰。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_pages=1024):
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def shared(cls, config):
+        """按配置获取当前进程的预加载记录"""
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls(config['preload_history_pages'])
+        return cls._shared
+
+    def hints(self, url):
+        """返回页面上次引用的资源[(代理地址, 类型)]"""
+        with self._lock:
+            hints = self._pages.get(url)
+            if hints is None:
+                self.misses += 1
+                return []
+            self._pages.move_to_end(url)
+            self.hits += 1
+            return hints
+
+    def record(self, url, hints):
+        with self._lock:
+            if not hints:
+                self._pages.pop(url, None)
+                return
+            self._pages[url] = list(hints)
+            self._pages.move_to_end(url)
+            while len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+
+    def stats(self):
+        """预加载记录统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'pages': len(self._pages),
+                'max_pages': self.max_pages,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+class _BodyCompressor:
+    """响应体的增量压缩器(gzip或brotli)"""
+
+    def __init__(self, encoding, config):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=config['brotli_quality'])
+        else:
+            self._compressor = zlib.compressobj(config['compression_level'], zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        """输出目前已压缩的全部数据，让客户端可以立即解压显示"""
+        if self.encoding == 'br':
+            return self._compressor.flush()
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class BoundedThreadPoolServer(socketserver.TCPServer):
+    """固定大小线程池的并发服务器
+
+    接受线程只负责把连接放入有界队列，由固定数量的工作线程处理，
+    队列满时直接返回503，避免突发流量下无限制地创建线程。
+    """
+
+    allow_reuse_address = True
+    # 空闲的长连接会一直占用工作线程，因此每个响应后都关闭连接
+    keep_alive = False
+
+    def __init__(self, server_address, handler_class, max_workers=32, queue_size=64, sock=None):
+        self.max_workers = max_workers
+        self.request_queue_size = max(queue_size, 5)
+        self._pending = queue.Queue(maxsize=queue_size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # 每个工作线程的计数只由该线程自己写入
+        self.worker_requests = [0] * max_workers
+        self.worker_connections = [0] * max_workers
+        self.rejected = 0
+        self.unassigned_requests = 0
+        if sock is None:
+            super().__init__(server_address, handler_class)
+        else:
+            # 使用主进程继承下来或以SO_REUSEPORT绑定的监听套接字
+            super().__init__(server_address, handler_class, bind_and_activate=False)
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+        self._workers = []
+        for index in range(max_workers):
+            worker = threading.Thread(target=self._worker_loop, args=(index,),
+                                      name=f"proxy-worker-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request, client_address):
+        """把连接交给线程池"""
+        try:
+            self._pending.put_nowait((request, client_address))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            self._reject(request)
+
+    def _reject(self, request):
+        """队列已满，返回503并关闭连接"""
+        try:
+            request.sendall(b'HTTP/1.0 503 Service Unavailable\r\n'
+                            b'Content-Type: text/plain\r\n'
+                            b'Content-Length: 0\r\n'
+                            b'Retry-After: 1\r\n'
+                            b'Connection: close\r\n\r\n')
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker_loop(self, index):
+        """工作线程主循环"""
+        self._local.index = index
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            request, client_address = item
+            self.worker_connections[index] += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def count_request(self):
+        """记录当前工作线程处理的请求数"""
+        index = getattr(self._local, 'index', None)
+        if index is None:
+            with self._lock:
+                self.unassigned_requests += 1
+        else:
+            self.worker_requests[index] += 1
+
+    def stats(self):
+        """线程池统计"""
+        worker_requests = list(self.worker_requests)
+        return {
+            'engine': 'thread',
+            'max_workers': self.max_workers,
+            'queue_size': self._pending.maxsize,
+            'queued': self._pending.qsize(),
+            'rejected': self.rejected,
+            'total_requests': sum(worker_requests) + self.unassigned_requests,
+            'worker_requests': worker_requests,
+            'worker_connections': list(self.worker_connections),
+        }
+
+    def server_close(self):
+        """停止工作线程并关闭监听套接字"""
+        super().server_close()
+        for _ in self._workers:
+            self._pending.put(None)
+        for worker in self._workers:
+            worker.join(timeout=1)
+
+
+class _AsyncRequest:
+    """asyncio引擎交给处理器的请求对象"""
+
+    def __init__(self, raw, wfile):
+        self.raw = raw
+        self.wfile = wfile
+
+
+class _LoopWriter(io.RawIOBase):
+    """在工作线程中把响应写回事件循环的StreamWriter"""
+
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if not data:
+            return 0
+        data = bytes(data)
+        # 发送缓冲未超过高水位时drain立即返回，只有慢客户端才会让工作线程等待
+        asyncio.run_coroutine_threadsafe(self._write(data), self._loop).result()
+        return len(data)
+
+    async def _write(self, data):
+        if self._writer.is_closing():
+            raise ConnectionResetError("client disconnected")
+        self._writer.write(data)
+        await self._writer.drain()
+
+
+class _AsyncHandlerMixin:
+    """让BaseHTTPRequestHandler在内存缓冲上处理单个请求"""
+
+    def setup(self):
+        self.connection = None
+        self.rfile = io.BytesIO(self.request.raw)
+        self.wfile = self.request.wfile
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+
+    def handle_expect_100(self):
+        # 引擎读取请求体之前已经回复过100 Continue
+        return True
+
+    def finish(self):
         pass
+
+
+class AsyncProxyServer:
+    """客户端连接I/O基于asyncio流的代理引擎
+
+    只有客户端一侧是异步的：连接的读取、解析和空闲保持都在事件循环中完成，
+    空闲或慢速上传的连接不占用线程。请求解析完成后，路由、上游请求和HTML重写
+    仍在有界线程池中用阻塞的requests执行，同时处理的请求数受max_workers限制，
+    上游缓慢时与线程池引擎一样会占满工作线程。这样不会阻塞事件循环，
+    并且与线程池引擎共用同一套处理器路由。
+    """
+
+    max_head_size = 65536
+    # 空闲连接只占用事件循环中的一个协程，可以保持长连接
+    keep_alive = True
+
+    def __init__(self, server_address, handler_class, max_workers=32,
+                 max_connections=10000, keepalive_timeout=15, sock=None):
+        self.server_address = server_address
+        self.handler_class = type('Async' + handler_class.__name__,
+                                  (_AsyncHandlerMixin, handler_class), {})
+        self.max_workers = max_workers
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.socket = sock or socket.create_server(server_address, backlog=1024)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._indexes = itertools.count()
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='proxy-async',
+                                           initializer=self._init_worker)
+        self.worker_requests = [0] * max_workers
+        self.unassigned_requests = 0
+        self.open_connections = 0
+        self.peak_connections = 0
+        self.rejected = 0
+
+    def _init_worker(self):
+        self._local.index = next(self._indexes)
+
+    def count_request(self):
+        """记录当前工作线程处理的请求数"""
+        index = getattr(self._local, 'index', None)
+        if index is None:
+            with self._lock:
+                self.unassigned_requests += 1
+        else:
+            self.worker_requests[index] += 1
+
+    def stats(self):
+        """引擎统计"""
+        worker_requests = list(self.worker_requests)
+        return {
+            'engine': 'async',
+            'max_workers': self.max_workers,
+            'max_connections': self.max_connections,
+            'open_connections': self.open_connections,
+            'peak_connections': self.peak_connections,
+            'rejected': self.rejected,
+            'total_requests': sum(worker_requests) + self.unassigned_requests,
+            'worker_requests': worker_requests,
+        }
+
+    async def _read_request(self, reader, writer, first):
+        """读取一个完整请求(请求头+请求体)，连接关闭时返回None
+
+        分块传输的请求体在这里解码，交给处理器的请求改为带Content-Length，
+        否则请求体会被当成长连接上的下一个请求。
+        """
+        timeout = None if first else self.keepalive_timeout
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return None
+        except asyncio.LimitOverrunError:
+            writer.write(b'HTTP/1.0 431 Request Header Fields Too Large\r\n'
+                         b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            return None
+
+        content_length = 0
+        expect_continue = False
+        chunked = False
+        lines = head.split(b'\r\n')
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            if name == b'content-length':
+                try:
+                    content_length = int(value.strip())
+                except ValueError:
+                    return None
+            elif name == b'transfer-encoding':
+                chunked = value.strip().lower().endswith(b'chunked')
+            elif name == b'expect' and value.strip().lower() == b'100-continue':
+                expect_continue = True
+
+        body = b''
+        if chunked or content_length > 0:
+            if expect_continue:
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            try:
+                if chunked:
+                    body = await self._read_chunked_body(reader)
+                else:
+                    body = await reader.readexactly(content_length)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                return None
+            except ValueError:
+                writer.write(b'HTTP/1.0 400 Bad Request\r\n'
+                             b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+                return None
+        if chunked:
+            # 同时出现Transfer-Encoding和Content-Length时以分块为准，两者都替换掉
+            kept = [line for line in lines[1:-2] if line.partition(b':')[0].strip().lower()
+                    not in (b'transfer-encoding', b'content-length')]
+            kept.append(b'Content-Length: ' + str(len(body)).encode('ascii'))
+            head = b'\r\n'.join([lines[0], *kept]) + b'\r\n\r\n'
+        return head + body
+
+    @staticmethod
+    async def _read_chunked_body(reader):
+        """读取并解码分块传输的请求体，格式错误时抛出ValueError"""
+        chunks = []
+        while True:
+            size_line = await reader.readuntil(b'\r\n')
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size < 0:
+                raise ValueError(size_line)
+            if size == 0:
+                break
+            chunks.append(await reader.readexactly(size))
+            if await reader.readexactly(2) != b'\r\n':
+                raise ValueError("missing chunk terminator")
+        # 跳过trailer，直到空行
+        while await reader.readuntil(b'\r\n') != b'\r\n':
+            pass
+        return b''.join(chunks)
+
+    def _run_handler(self, raw, loop, writer, client_address):
+        """在工作线程中运行处理器，返回是否关闭连接"""
+        request = _AsyncRequest(raw, _LoopWriter(loop, writer))
+        handler = self.handler_class(request, client_address, self)
+        return handler.close_connection
+
+    async def _handle_connection(self, reader, writer):
+        """处理一个客户端连接"""
+        if self.open_connections >= self.max_connections:
+            self.rejected += 1
+            writer.write(b'HTTP/1.0 503 Service Unavailable\r\n'
+                         b'Content-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+
+        self.open_connections += 1
+        self.peak_connections = max(self.peak_connections, self.open_connections)
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info('peername') or ('', 0)
+        first = True
+        try:
+            while True:
+                raw = await self._read_request(reader, writer, first)
+                if raw is None:
+                    break
+                first = False
+                close = await loop.run_in_executor(self.executor, self._run_handler,
+                                                   raw, loop, writer, client_address)
+                if close:
+                    break
+        except Exception as e:
+            print(f"连接处理错误: {e}")
+        finally:
+            self.open_connections -= 1
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle_connection, sock=self.socket,
+                                            limit=self.max_head_size)
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self):
+        """运行事件循环直到被中断"""
+        asyncio.run(self._serve())
+
+    def server_close(self):
+        """关闭监听套接字和线程池"""
+        self.socket.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+
+def _create_server(config, sock=None):
+    """按配置创建服务引擎"""
+    address = ("", config['port'])
+    if config['engine'] == 'async':
+        return AsyncProxyServer(address, FixedProxyHandler,
+                                max_workers=config['max_workers'],
+                                max_connections=config['async_max_connections'],
+                                keepalive_timeout=config['keepalive_timeout'],
+                                sock=sock)
+    return BoundedThreadPoolServer(address, FixedProxyHandler,
+                                   max_workers=config['max_workers'],
+                                   queue_size=config['accept_queue_size'],
+                                   sock=sock)
+
+
+class PreforkSupervisor:
+    """多进程预派生模式的主进程
+
+    每个工作进程运行一个完整的服务引擎。支持SO_REUSEPORT时各进程自行绑定端口，
+    由内核分配连接；否则所有进程共享主进程创建的监听套接字。
+    主进程负责重启崩溃的工作进程，并定期输出每个进程处理的请求数。
+    """
+
+    restart_delay = 1.0
+
+    def __init__(self, config, workers):
+        self.config = config
+        self.workers = workers
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        self.shared_socket = None
+        # 以下计数放在共享内存中，工作进程的统计接口也能看到所有进程的数据；
+        # 每个工作进程定期把自己的请求总数写入对应槽位
+        self.request_counts = multiprocessing.RawArray('Q', workers)
+        self.retired_counts = multiprocessing.RawArray('Q', workers)
+        self.restarts = multiprocessing.RawArray('Q', workers)
+        self.slot_pids = multiprocessing.RawArray('q', workers)
+        self.pids = {}
+        self.running = False
+
+    def stats(self):
+        """各工作进程的请求统计"""
+        return [{
+            'slot': slot,
+            'pid': self.slot_pids[slot],
+            'requests': self.retired_counts[slot] + self.request_counts[slot],
+            'restarts': self.restarts[slot],
+        } for slot in range(self.workers)]
+
+    def _listen(self):
+        return socket.create_server(("", self.config['port']), backlog=1024,
+                                    reuse_port=self.reuse_port)
+
+    def _spawn(self, slot):
+        self.request_counts[slot] = 0
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = slot
+            self.slot_pids[slot] = pid
+            return
+        # 子进程
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            sock = self.shared_socket or self._listen()
+            httpd = _create_server(self.config, sock=sock)
+            httpd.supervisor = self
+            threading.Thread(target=self._publish_counts, args=(httpd, slot), daemon=True).start()
+            httpd.serve_forever()
+        except Exception as e:
+            print(f"工作进程 {os.getpid()} 异常退出: {e}")
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _publish_counts(self, httpd, slot):
+        while True:
+            time.sleep(1)
+            self.request_counts[slot] = httpd.stats()['total_requests']
+
+    def _report(self):
+        for item in self.stats():
+            print(f"工作进程 #{item['slot']} (pid {item['pid']}): "
+                  f"请求 {item['requests']}, 重启 {item['restarts']}")
+
+    def _stop(self, signum, frame):
+        self.running = False
+
+    def run(self):
+        """启动工作进程并监督其运行"""
+        if not self.reuse_port:
+            self.shared_socket = self._listen()
+        self.running = True
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+        last_report = time.monotonic()
+        while self.running:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid and pid in self.pids:
+                slot = self.pids.pop(pid)
+                self.retired_counts[slot] += self.request_counts[slot]
+                self.request_counts[slot] = 0
+                self.restarts[slot] += 1
+                print(f"工作进程 #{slot} (pid {pid}) 已退出，状态 {status}，正在重启")
+                time.sleep(self.restart_delay)
+                if self.running:
+                    self._spawn(slot)
+                continue
+            if time.monotonic() - last_report >= self.config['stats_interval']:
+                self._report()
+                last_report = time.monotonic()
+            time.sleep(0.2)
+
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.pids):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self._report()
+        if self.shared_socket:
+            self.shared_socket.close()
+
+
+def run_proxy_server():
+    """运行代理服务器"""
+    config = FixedProxyHandler.config
+    port = config['port']
     
-    with socketserver.TCPServer(("", port), FixedProxyHandler) as httpd:
+    try:
+        import urllib3
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    except:
+        pass
+
+    # 在派生工作进程之前完成解析器自检，子进程直接沿用结果
+    ParserBackend.shared(config).select()
+
+    workers = config['worker_processes']
+    if workers > 1:
+        if hasattr(os, 'fork'):
+            print(f"代理服务器以 {workers} 个工作进程启动在端口 {port}")
+            print(f"服务引擎: {config['engine']}, 每进程工作线程: {config['max_workers']}")
+            print("按 Ctrl+C 停止服务器")
+            PreforkSupervisor(config, workers).run()
+            print("\n服务器已停止")
+            return
+        print("当前平台不支持fork，使用单进程模式")
+
+    with _create_server(config) as httpd:
         print("代理服务器已启动在端口 " + str(port))
+        print(f"服务引擎: {config['engine']}, 工作线程: {config['max_workers']}")
         print("访问地址: http://localhost:" + str(port))
         print("按 Ctrl+C 停止服务器")
         
@@ -773,5 +4417,74 @@ def run_proxy_server():
         except KeyboardInterrupt:
             print("\n服务器已停止")
 
+def benchmark_rewriters(path, base_url='https://example.com/', rounds=5):
+    """比较整页解析和流式重写的吞吐量、首块输出耗时与峰值内存"""
+    with open(path, 'rb') as f:
+        content = f.read().decode('utf-8', errors='replace')
+    size_mb = len(content.encode('utf-8')) / (1024 * 1024)
+    handler = FixedProxyHandler.__new__(FixedProxyHandler)
+    chunk_size = handler.config['stream_chunk_size']
+
+    def text_chunks():
+        for offset in range(0, len(content), chunk_size):
+            yield content[offset:offset + chunk_size]
+
+    rewriters = {}
+    for parser in ParserBackend.modules:
+        if ParserBackend.available(parser):
+            rewriters[f'soup/{parser}'] = (
+                lambda parser=parser: handler._rewrite_html_chunks(content, base_url, parser))
+    rewriters['stream'] = lambda: handler._rewrite_html_stream(text_chunks(), base_url)
+    print(f"测试页面: {path} ({size_mb:.2f} MB), 重复 {rounds} 次")
+    for name, rewrite in rewriters.items():
+        first_chunk = 0.0
+        start = time.perf_counter()
+        for _ in range(rounds):
+            round_start = time.perf_counter()
+            chunks = iter(rewrite())
+            next(chunks, None)
+            first_chunk += time.perf_counter() - round_start
+            for _ in chunks:
+                pass
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        for _ in rewrite():
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f"{name:>16}: {size_mb * rounds / elapsed:8.2f} MB/s, "
+              f"首块输出 {first_chunk / rounds * 1000:8.1f} ms, 峰值内存 {peak / (1024 * 1024):8.2f} MB")
+
+def _parse_args(config):
+    """解析命令行参数并写入配置"""
+    parser = argparse.ArgumentParser(description="HTTP代理服务器")
+    parser.add_argument('--port', type=int, default=config['port'], help="监听端口")
+    parser.add_argument('--workers', type=int, default=config['worker_processes'],
+                        help="预派生工作进程数")
+    parser.add_argument('--threads', type=int, default=config['max_workers'],
+                        help="每个进程的工作线程数")
+    parser.add_argument('--engine', choices=['thread', 'async'], default=config['engine'],
+                        help="服务引擎，async只把客户端连接I/O放到事件循环中")
+    parser.add_argument('--rewriter', choices=['soup', 'stream'], default=config['html_rewriter'],
+                        help="HTML重写方式")
+    parser.add_argument('--parser', choices=['auto', *ParserBackend.modules], default=config['html_parser'],
+                        help="BeautifulSoup解析器")
+    parser.add_argument('--bench-rewrite', metavar='FILE',
+                        help="对指定HTML文件比较两种重写方式的性能后退出")
+    args = parser.parse_args()
+    config['port'] = args.port
+    config['worker_processes'] = max(1, args.workers)
+    config['max_workers'] = max(1, args.threads)
+    config['engine'] = args.engine
+    config['html_rewriter'] = args.rewriter
+    config['html_parser'] = args.parser
+    return args
+
 if __name__ == "__main__":
-    run_proxy_server()
+    args = _parse_args(FixedProxyHandler.config)
+    if args.bench_rewrite:
+        benchmark_rewriters(args.bench_rewrite)
+    else:
+        run_proxy_server()
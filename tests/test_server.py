@@ -0,0 +1,126 @@
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import unittest
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'public'))
+
+import server  # noqa: E402
+
+
+def make_response(url, headers, request_headers=None):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict(headers)
+    response.request = requests.Request('GET', url, headers=request_headers or {}).prepare()
+    return response
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_store_twice_replaces_variant(self):
+        cache = server.ResponseCache(max_bytes=1024 * 1024, max_entry_bytes=1024)
+        url = 'http://example.com/a.js'
+        headers = {'Cache-Control': 'max-age=60', 'ETag': '"v1"'}
+        cache.store(url, make_response(url, headers), b'first', None)
+        cache.store(url, make_response(url, headers), b'second', None)
+
+        entry = cache.lookup(url, {})
+        self.assertEqual(entry.body, b'second')
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['size'], entry.size)
+
+    def test_store_keeps_other_vary_variants(self):
+        cache = server.ResponseCache(max_bytes=1024 * 1024, max_entry_bytes=1024)
+        url = 'http://example.com/a.css'
+        headers = {'Cache-Control': 'max-age=60', 'Vary': 'User-Agent'}
+        cache.store(url, make_response(url, headers, {'User-Agent': 'a'}), b'a', None)
+        cache.store(url, make_response(url, headers, {'User-Agent': 'b'}), b'b', None)
+
+        self.assertEqual(cache.lookup(url, {'User-Agent': 'a'}).body, b'a')
+        self.assertEqual(cache.lookup(url, {'User-Agent': 'b'}).body, b'b')
+        self.assertEqual(cache.stats()['entries'], 2)
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    def store(self, cache, url, body):
+        path = os.path.join(cache.temp_dir, 'upload')
+        with open(path, 'wb') as f:
+            f.write(body)
+        headers = {'Cache-Control': 'max-age=60', 'ETag': '"%s"' % url}
+        cache.commit(url, make_response(url, headers), path, url.rsplit('/', 1)[-1], len(body))
+
+    def test_evict_removes_metadata(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = server.DiskCache(directory, max_bytes=150, min_size=1)
+            self.store(cache, 'http://example.com/a', b'a' * 100)
+            os.utime(os.path.join(cache.blob_dir, 'a'), (0, 0))
+            self.store(cache, 'http://example.com/b', b'b' * 100)
+
+            self.assertEqual(os.listdir(cache.meta_dir), [os.path.basename(cache._meta_path('http://example.com/b'))])
+            self.assertIsNone(cache.lookup('http://example.com/a'))
+            self.assertIsNotNone(cache.lookup('http://example.com/b'))
+
+
+class NegativeCacheTest(unittest.TestCase):
+
+    def test_host_counters_are_bounded(self):
+        cache = server.NegativeCache(max_entries=16, ttls={'not_found': 60}, max_hosts=2)
+        for host in ('a.com', 'b.com', 'c.com'):
+            cache.record_status(f'http://{host}/x.png', 404)
+
+        self.assertEqual(list(cache.stats()['hosts']), ['b.com', 'c.com'])
+        self.assertIsNotNone(cache.lookup('http://a.com/x.png'))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_evicts_closed_circuits_first(self):
+        breaker = server.CircuitBreaker(min_requests=1, error_rate=0.5, max_hosts=2)
+        breaker.record('a.com', True, 0.1)
+        breaker.record('b.com', False, 0.1)
+        breaker.record('c.com', False, 0.1)
+
+        self.assertEqual(breaker.stats()['tracked_hosts'], 2)
+        self.assertEqual(breaker.allow('a.com'), (False, False))
+
+
+class AsyncReadRequestTest(unittest.TestCase):
+
+    def read_requests(self, data, count):
+        sock, peer = socket.socketpair()
+        proxy = server.AsyncProxyServer(('', 0), server.FixedProxyHandler, max_workers=1, sock=sock)
+        self.addCleanup(peer.close)
+        self.addCleanup(proxy.server_close)
+
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return [await proxy._read_request(reader, None, True) for _ in range(count)]
+        return asyncio.run(run())
+
+    def test_chunked_body_is_decoded(self):
+        post = (b'POST /proxy?url=http://example.com/ HTTP/1.1\r\nHost: x\r\n'
+                b'Transfer-Encoding: chunked\r\n\r\n'
+                b'5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n')
+        get = b'GET / HTTP/1.1\r\nHost: x\r\n\r\n'
+        first, second = self.read_requests(post + get, 2)
+
+        head, _, body = first.partition(b'\r\n\r\n')
+        self.assertEqual(body, b'hello world')
+        self.assertIn(b'Content-Length: 11', head)
+        self.assertNotIn(b'Transfer-Encoding', head)
+        self.assertEqual(second, get)
+
+
+if __name__ == '__main__':
+    unittest.main()